@@ -0,0 +1,261 @@
+import gc
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from builddb import SimpleDB
+
+
+# asyncio front-end
+## db = await AsyncSimpleDB.open("app.json", wal=True)
+## await db.insert_into("events", [1, "start"])
+## rows = await db.select_from("events", "id", where={"id": 1})
+## All writes go through one queue drained by a single writer task. Inserts waiting in the queue
+## are applied together (consecutive inserts into one table become one insert_many) in chunks of
+## about chunk_rows, giving the event loop a turn after each chunk, and with a write-ahead log they
+## are made durable by one fsync for the whole group before any of them returns.
+## Every caller gets the outcome of its own rows: they are checked on their own, a chunk only
+## holds whole callers and is inserted all or nothing, and a chunk that fails is retried caller by
+## caller. A caller with more than chunk_rows rows is inserted in chunks of its own, so as with
+## SimpleDB.insert_many an error leaves its earlier chunks inserted.
+## The writes themselves (checking and inserting each chunk too), the fsync, reads and file I/O
+## (open, save, checkpoint) run in threads; the event loop only groups the queue and resolves futures.
+## freeze=True freezes every object alive after each group (gc.freeze), so the collector's full
+## passes no longer walk every stored row and stall the loop. That is process wide: garbage cycles
+## anywhere in the program that are not collected yet are frozen too and never freed, so it is
+## only worth it when the stored rows are most of what the process holds.
+
+class AsyncSimpleDB:
+    def __init__(self, db, chunk_rows=256, max_batch=10000, freeze=False):
+        self.db = db
+        self.chunk_rows = chunk_rows
+        self.max_batch = max_batch
+        self.freeze = freeze
+        # the writer does the fsync once per group, so the log is not synced on every insert
+        self.durable = db.wal and db.sync
+        db.sync = False
+        self.queue = None
+        self.writer = None
+        # one thread for writes keeps them in order; reads get their own pool
+        self.write_executor = ThreadPoolExecutor(1)
+        self.read_executor = ThreadPoolExecutor()
+
+    @classmethod
+    async def open(cls, filename, chunk_rows=256, max_batch=10000, freeze=False, **options):
+        db = await asyncio.get_running_loop().run_in_executor(None, functools.partial(SimpleDB, filename, **options))
+        return cls(db, chunk_rows, max_batch, freeze)
+
+    # writes
+
+    async def submit(self, operation, arguments):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        # a writer that has finished (or died) is replaced; it picks up whatever is still queued
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.get_running_loop().create_task(self.write())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((operation, arguments, future))
+        return await future
+
+    async def insert_into(self, table_name, values):
+        await self.submit("insert", (table_name, [values]))
+
+    async def insert_many(self, table_name, rows):
+        rows = list(rows)
+        await self.submit("insert", (table_name, rows))
+        return len(rows)
+
+    async def create_table(self, name, columns, storage="rows", types=None):
+        return await self.submit("call", (self.db.create_table, name, columns, storage, types))
+
+    async def create_index(self, table_name, column, kind="hash"):
+        return await self.submit("call", (self.db.create_index, table_name, column, kind))
+
+    async def update(self, table_name, where, set):
+        return await self.submit("call", (self.db.update, table_name, where, set))
+
+    async def delete_from(self, table_name, where=None):
+        return await self.submit("call", (self.db.delete_from, table_name, where))
+
+    async def write(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            while len(items) < self.max_batch and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            stop = items[-1] is None
+            if stop:
+                items.pop()
+            finished = []
+            group = []
+            for number, (operation, arguments, future) in enumerate(items):
+                if operation == "insert":
+                    group.append((arguments, future))
+                    following = items[number + 1] if number + 1 < len(items) else None
+                    if following and following[0] == "insert" and following[1][0] == arguments[0]:
+                        continue
+                    try:
+                        finished += await self.apply_inserts(group)
+                    except Exception as error:
+                        # whatever goes wrong with a group fails its own callers, not the writer
+                        finished += [(future, None, error) for _, future in group]
+                    group = []
+                    continue
+                function, *rest = arguments
+                try:
+                    finished.append((future, await loop.run_in_executor(self.write_executor, function, *rest), None))
+                except Exception as error:
+                    finished.append((future, None, error))
+            if self.durable and finished:
+                # one fsync for everything applied above; if it fails, none of it is durable
+                try:
+                    await loop.run_in_executor(self.write_executor, self.db.save)
+                except Exception as error:
+                    finished = [(future, None, error if failed is None else failed)
+                                for future, _, failed in finished]
+            if self.freeze:
+                gc.freeze()
+            for number, (future, result, error) in enumerate(finished, 1):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+                if number % self.chunk_rows == 0:
+                    await asyncio.sleep(0)
+            if stop:
+                return
+
+    async def apply_inserts(self, group):
+        # inserts into one table, applied together chunk by chunk; each caller's rows are checked
+        # on their own, so rows with the wrong number of values or types fail only their caller
+        table_name = group[0][0][0]
+        finished = []
+        try:
+            table = self.db.get_table(table_name)
+        except Exception as error:
+            return [(future, None, error) for _, future in group]
+        errors = await asyncio.get_running_loop().run_in_executor(
+            self.write_executor, self.check_batches, table, [batch for (_, batch), _ in group])
+        # whole callers waiting for the next chunk, as (rows, future)
+        callers = []
+        size = 0
+        for ((_, batch), future), error in zip(group, errors):
+            if error is not None:
+                finished.append((future, None, error))
+                continue
+            if len(batch) > self.chunk_rows:
+                if callers:
+                    finished += await self.insert_chunk(table_name, callers)
+                    callers, size = [], 0
+                finished += await self.insert_large(table_name, batch, future)
+                continue
+            callers.append((batch, future))
+            size += len(batch)
+            if size >= self.chunk_rows:
+                finished += await self.insert_chunk(table_name, callers)
+                callers, size = [], 0
+        if callers:
+            finished += await self.insert_chunk(table_name, callers)
+        return finished
+
+    def check_batches(self, table, batches):
+        # the error of each caller's rows, or None when they can be inserted; not only ValueError:
+        # rows that are not lists (insert_into("t", 5)) raise TypeError
+        width = len(table.columns)
+        errors = []
+        for batch in batches:
+            try:
+                if any(len(values) != width for values in batch):
+                    raise ValueError("The number of values does not match the number of columns")
+                if table.types:
+                    table.typed(batch)
+                errors.append(None)
+            except Exception as error:
+                errors.append(error)
+        return errors
+
+    async def insert_chunk(self, table_name, callers):
+        # the rows of several callers as one batch, which is inserted all or nothing; when it
+        # fails the callers are retried one at a time, so only those with bad rows get the error
+        rows = [values for batch, _ in callers for values in batch]
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.write_executor, self.db.insert_many, table_name, rows, len(rows) or 1)
+            finished = [(future, None, None) for _, future in callers]
+        except Exception as error:
+            if len(callers) == 1:
+                finished = [(callers[0][1], None, error)]
+            else:
+                finished = []
+                for caller in callers:
+                    finished += await self.insert_chunk(table_name, [caller])
+        return finished
+
+    async def insert_large(self, table_name, rows, future):
+        # one caller's rows, chunk by chunk
+        loop = asyncio.get_running_loop()
+        try:
+            for start in range(0, len(rows), self.chunk_rows):
+                chunk = rows[start:start + self.chunk_rows]
+                await loop.run_in_executor(self.write_executor, self.db.insert_many, table_name, chunk, len(chunk))
+        except Exception as error:
+            return [(future, None, error)]
+        return [(future, None, None)]
+
+    # reads
+
+    async def read(self, function, *arguments, **options):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.read_executor, functools.partial(function, *arguments, **options))
+
+    async def select_from(self, table_name, *columns, where=None, limit=None, offset=0, order_by=None):
+        return await self.read(self.db.select_from, table_name, *columns, where=where, limit=limit, offset=offset,
+                               order_by=order_by)
+
+    async def aggregate_from(self, table_name, group_by=(), where=None, **aggregates):
+        return await self.read(self.db.aggregate_from, table_name, group_by, where=where, **aggregates)
+
+    def stats(self):
+        return self.db.stats()
+
+    # files
+
+    async def save(self):
+        await self.read(self.db.save)
+
+    async def checkpoint(self):
+        await self.read(self.db.checkpoint)
+
+    async def vacuum(self, table_name=None, min_dead=0.0):
+        return await self.read(self.db.vacuum, table_name, min_dead)
+
+    async def close(self):
+        # waits for every queued write, then closes the database
+        if self.writer is not None and not self.writer.done():
+            await self.queue.put(None)
+            await self.writer
+            self.writer = None
+        loop = asyncio.get_running_loop()
+        if self.durable:
+            await loop.run_in_executor(self.write_executor, self.db.save)
+        await loop.run_in_executor(self.write_executor, self.db.close)
+        self.write_executor.shutdown()
+        self.read_executor.shutdown()
+
+
+# usage
+async def main():
+    db = await AsyncSimpleDB.open('events.json', wal=True)
+    if 'events' not in db.db.tables:
+        await db.create_table('events', ['id', 'kind'])
+
+    # many concurrent inserts are committed together
+    await asyncio.gather(*(db.insert_into('events', [number, 'click']) for number in range(1000)))
+    print(await db.aggregate_from('events', group_by=['kind'], count=True))
+
+    await db.checkpoint()
+    await db.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from builddb import SimpleDB
+
+try:
+    import resource
+except ImportError:
+    resource = None
+# Benchmarks for builddb.SimpleDB.
+#   python bench_builddb.py run --rows 100000 --baseline baseline.json
+#   python bench_builddb.py stress columns
+
+
+# synthetic data
+## A schema is a list of (column, kind) pairs; kinds are "int" (unique ids), "float",
+## "str" (mostly distinct text) and "category" (a handful of repeated strings).
+## The same seed always produces the same rows.
+
+DEFAULT_SCHEMA = [("id", "int"), ("name", "str"), ("position", "category"), ("salary", "float")]
+CATEGORIES = ["Engineer", "Manager", "Intern", "Director", "Analyst"]
+
+
+def parse_schema(text):
+    # "id:int,name:str" -> [("id", "int"), ("name", "str")]
+    schema = [tuple(part.split(":")) for part in text.split(",")]
+    for column, kind in schema:
+        if kind not in ("int", "float", "str", "category"):
+            raise ValueError(f"Unknown column kind {kind}")
+    return schema
+
+
+def generate_rows(schema, rows, seed=0):
+    rng = random.Random(seed)
+    makers = {
+        "int": lambda number: number,
+        "float": lambda number: round(rng.uniform(1000, 10000), 2),
+        "str": lambda number: f"name{rng.randrange(rows)}",
+        "category": lambda number: rng.choice(CATEGORIES),
+    }
+    columns = [makers[kind] for _, kind in schema]
+    return [[make(number) for make in columns] for number in range(rows)]
+
+
+# timing
+## Each operation is timed one call at a time, and reported as ops/sec plus latency percentiles.
+
+def percentile(sorted_times, fraction):
+    return sorted_times[min(len(sorted_times) - 1, int(fraction * len(sorted_times)))]
+
+
+def summarize(times):
+    times = sorted(times)
+    total = sum(times)
+    return {
+        "calls": len(times),
+        "ops_per_sec": len(times) / total if total else float("inf"),
+        "p50_ms": percentile(times, 0.50) * 1000,
+        "p95_ms": percentile(times, 0.95) * 1000,
+        "p99_ms": percentile(times, 0.99) * 1000,
+    }
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - started
+
+
+def peak_rss_mb():
+    # the largest resident set size of this process so far (not available on Windows)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_benchmarks(rows=100000, schema=DEFAULT_SCHEMA, storage="rows", binary=False,
+                   queries=200, repeat=3, seed=0, directory=None):
+    if directory is None:
+        # the files live in a temporary directory that is removed afterwards
+        with tempfile.TemporaryDirectory() as directory:
+            return run_benchmarks(rows, schema, storage, binary, queries, repeat, seed, directory)
+    filename = os.path.join(directory, "bench.sdb" if binary else "bench.json")
+    data = generate_rows(schema, rows, seed)
+    columns = [column for column, _ in schema]
+    key = columns[0]
+    results = {}
+
+    db = SimpleDB(filename, binary=binary)
+    db.create_table("bench", columns, storage=storage)
+    db.create_index("bench", key)
+    results["insert_into"] = summarize([timed(db.insert_into, "bench", values) for values in data])
+
+    rng = random.Random(seed)
+    lookups = [{key: data[rng.randrange(rows)][0]} for _ in range(queries)]
+    results["select_from_point"] = summarize([timed(db.select_from, "bench", *columns, where=where)
+                                              for where in lookups])
+    results["select_from_scan"] = summarize([timed(db.select_from, "bench", *columns) for _ in range(repeat)])
+
+    results["save"] = summarize([timed(db.save) for _ in range(repeat)])
+    results["load"] = summarize([timed(SimpleDB, filename) for _ in range(repeat)])
+    db.close()
+    results["peak_rss_mb"] = peak_rss_mb()
+    results["config"] = {"rows": rows, "schema": schema, "storage": storage, "binary": binary}
+    return results
+
+
+# baselines
+## A baseline file keeps one result set per configuration. A run fails when any
+## operation's ops/sec drops more than threshold (a fraction) below its baseline.
+
+def baseline_key(config):
+    return f"{config['storage']}/{'binary' if config['binary'] else 'json'}/{config['rows']}/" + \
+        ",".join(f"{column}:{kind}" for column, kind in config["schema"])
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for operation, before in baseline.items():
+        after = results.get(operation)
+        if not isinstance(before, dict) or "ops_per_sec" not in before or not after:
+            continue
+        if after["ops_per_sec"] < before["ops_per_sec"] * (1 - threshold):
+            regressions.append(f"{operation}: {after['ops_per_sec']:.0f} ops/s, "
+                               f"baseline {before['ops_per_sec']:.0f} ops/s")
+    return regressions
+
+
+def report(results):
+    for operation, summary in results.items():
+        if isinstance(summary, dict) and "ops_per_sec" in summary:
+            print(f"{operation:<20} {summary['ops_per_sec']:>12.1f} ops/s  p50 {summary['p50_ms']:.3f} ms  "
+                  f"p95 {summary['p95_ms']:.3f} ms  p99 {summary['p99_ms']:.3f} ms  ({summary['calls']} calls)")
+    if results.get("peak_rss_mb") is not None:
+        print(f"peak RSS {results['peak_rss_mb']:.1f} MB")
+
+
+# concurrency stress test
+## Writer threads insert rows while reader threads query them and one thread keeps saving.
+## Every read checks that it saw a consistent table, and the run reports operations per
+## second for each thread count so the scaling can be compared.
+
+def stress(threads, seconds=2.0, storage="rows", directory=None):
+    if directory is None:
+        with tempfile.TemporaryDirectory() as directory:
+            return stress(threads, seconds, storage, directory)
+    db = SimpleDB(os.path.join(directory, f"stress_{threads}.json"))
+    db.create_table("events", ["id", "writer", "double"], storage=storage)
+    db.create_index("events", "writer")
+
+    stop = threading.Event()
+    counts = {"insert": 0, "select": 0, "save": 0}
+    errors = []
+    counts_lock = threading.Lock()
+
+    def writer(number):
+        done = 0
+        while not stop.is_set():
+            db.insert_into("events", [done, number, done * 2])
+            done += 1
+        with counts_lock:
+            counts["insert"] += done
+
+    def reader(number):
+        done = 0
+        while not stop.is_set():
+            rows = db.select_from("events", "id", "double", where={"writer": number % threads}, limit=1000)
+            # each writer's rows are visible as a gap-free prefix of what it wrote
+            if any(row["double"] != row["id"] * 2 for row in rows) or \
+                    [row["id"] for row in rows] != list(range(len(rows))):
+                errors.append(f"reader {number} saw an inconsistent snapshot")
+            done += 1
+        with counts_lock:
+            counts["select"] += done
+
+    def saver():
+        while not stop.is_set():
+            db.save()
+            counts["save"] += 1
+
+    workers = [threading.Thread(target=writer, args=(n,)) for n in range(threads)]
+    workers += [threading.Thread(target=reader, args=(n,)) for n in range(threads)]
+    workers.append(threading.Thread(target=saver))
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    if len(db.tables["events"]) != counts["insert"]:
+        errors.append("rows were lost")
+    db.close()
+    saved = SimpleDB(db.filename)
+    if len(saved.tables["events"]) > counts["insert"]:
+        errors.append("the saved file has rows that were never inserted")
+    saved.close()
+    return {
+        "threads": threads,
+        "inserts_per_sec": counts["insert"] / elapsed,
+        "selects_per_sec": counts["select"] / elapsed,
+        "saves": counts["save"],
+        "errors": errors,
+    }
+
+
+def stress_report(thread_counts=(1, 2, 4, 8), seconds=2.0, storage="rows"):
+    base = None
+    for threads in thread_counts:
+        result = stress(threads, seconds, storage)
+        base = base or result["inserts_per_sec"] + result["selects_per_sec"]
+        total = result["inserts_per_sec"] + result["selects_per_sec"]
+        print(f"{threads:>3} threads: {result['inserts_per_sec']:>10.0f} inserts/s "
+              f"{result['selects_per_sec']:>8.0f} selects/s {result['saves']:>4} saves "
+              f"scaling x{total / base:.2f} {'OK' if not result['errors'] else result['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for builddb.SimpleDB")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="time insert_into, select_from, save and load")
+    run.add_argument("--rows", type=int, default=100000)
+    run.add_argument("--schema", type=parse_schema, default=DEFAULT_SCHEMA,
+                     help="column:kind pairs, e.g. id:int,name:str,position:category,salary:float")
+    run.add_argument("--storage", choices=["rows", "columns"], default="rows")
+    run.add_argument("--binary", action="store_true", help="save in the binary file format")
+    run.add_argument("--queries", type=int, default=200)
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--baseline", help="JSON file of baselines to compare against")
+    run.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, as a fraction")
+    run.add_argument("--update-baseline", action="store_true", help="store this run as the baseline")
+    stress_command = commands.add_parser("stress", help="multi-threaded stress test")
+    stress_command.add_argument("storage", nargs="?", choices=["rows", "columns"], default="rows")
+    stress_command.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    if args.command == "stress":
+        stress_report(seconds=args.seconds, storage=args.storage)
+        return 0
+
+    results = run_benchmarks(args.rows, args.schema, args.storage, args.binary,
+                             args.queries, args.repeat, args.seed)
+    report(results)
+    if not args.baseline:
+        return 0
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    key = baseline_key(results["config"])
+    if args.update_baseline or key not in baselines:
+        baselines[key] = results
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=4)
+        print(f"baseline for {key} saved to {args.baseline}")
+        return 0
+    regressions = compare(results, baselines[key], args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import io
+import sys
+import time
+import random
+import argparse
+import contextlib
+import tracemalloc
+
+# task_bank runs its example on import
+with contextlib.redirect_stdout(io.StringIO()):
+    from task_bank import Account, CheckingAccount, SavingsAccount, AccountStore, Bank, TransferEngine
+# Memory benchmark for the task_bank accounts, and throughput of TransferEngine with --transfers.
+#   python bench_task_bank.py --accounts 1000000
+#   python bench_task_bank.py --accounts 100000 --transfers 200000 --workers 1,2,8
+
+
+# the accounts as they were before __slots__ and cents
+## A plain class per account with a __dict__ and a float balance, kept here to compare against.
+
+class LegacyAccount:
+    def __init__(self, account_number, owner, initial_balance=0):
+        self.account_number = account_number
+        self.owner = owner
+        self.balance = initial_balance
+        self.ledger = None
+        self.ledger_id = None
+
+
+class LegacyCheckingAccount(LegacyAccount):
+    def __init__(self, account_number, owner, initial_balance=0, transaction_fee=1.00):
+        super().__init__(account_number, owner, initial_balance)
+        self.transaction_fee = transaction_fee
+
+
+class LegacySavingsAccount(LegacyAccount):
+    def __init__(self, account_number, owner, initial_balance=0, interest_rate=0.01):
+        super().__init__(account_number, owner, initial_balance)
+        self.interest_rate = interest_rate
+
+
+# synthetic accounts
+## A third of each kind, owners drawn from a pool of owners / 3 names so most own several accounts.
+## The account numbers and owner names are made before measuring, since every layout shares them;
+## balances come as cents, so each layout makes its own balance objects (or none).
+
+def generate_accounts(accounts, seed=0):
+    rng = random.Random(seed)
+    owners = [f"owner{number}" for number in range(max(1, accounts // 3))]
+    return [(f"{number:010d}", rng.choice(owners), rng.randrange(1000000), number % 3)
+            for number in range(accounts)]
+
+
+def build_objects(data, classes):
+    account, checking, savings = classes
+    accounts = {}
+    for number, owner, cents, kind in data:
+        balance = cents / 100
+        if kind == 0:
+            accounts[number] = account(number, owner, balance)
+        elif kind == 1:
+            accounts[number] = checking(number, owner, balance, 1.5)
+        else:
+            accounts[number] = savings(number, owner, balance, 0.02)
+    return accounts
+
+
+def build_store(data):
+    store = AccountStore()
+    for number, owner, cents, kind in data:
+        store.add_row(number, owner, kind, cents, 150 if kind == 1 else 0,
+                      20000000 if kind == 2 else 0)
+    return store
+
+
+LAYOUTS = {
+    "dict objects": lambda data: build_objects(data, (LegacyAccount, LegacyCheckingAccount, LegacySavingsAccount)),
+    "slots objects": lambda data: build_objects(data, (Account, CheckingAccount, SavingsAccount)),
+    "AccountStore": build_store,
+}
+
+
+# transfer throughput
+## One batch of random transfers between the synthetic accounts, run by TransferEngine once per
+## number of workers, each time on a new bank so every run starts from the same balances.
+
+KIND_NAMES = ("Account", "CheckingAccount", "SavingsAccount")
+
+
+def generate_transfers(data, transfers, seed=0):
+    rng = random.Random(seed + 1)
+    numbers = [number for number, _, _, _ in data]
+    return [(rng.choice(numbers), rng.choice(numbers), rng.randrange(1, 100000) / 100) for _ in range(transfers)]
+
+
+def measure_transfers(data, transfers, workers):
+    bank = Bank()
+    bank.add_accounts([(number, owner, KIND_NAMES[kind], cents, None, None) for number, owner, cents, kind in data])
+    engine = TransferEngine(bank, workers=workers)
+    started = time.perf_counter()
+    results = engine.run(transfers)
+    elapsed = time.perf_counter() - started
+    engine.close()
+    return {"per_sec": len(transfers) / elapsed, "settled": sum(result["ok"] for result in results)}
+
+
+def measure(build, data):
+    # bytes allocated by build that are still alive once it returns, and how long it took
+    tracemalloc.start()
+    started = time.perf_counter()
+    accounts = build(data)
+    elapsed = time.perf_counter() - started
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del accounts
+    return {"bytes": size, "seconds": elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory benchmark for the task_bank accounts")
+    parser.add_argument("--accounts", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--transfers", type=int, default=0, help="measure transfer throughput instead")
+    parser.add_argument("--workers", default="1,2,4,8", help="worker counts for --transfers")
+    args = parser.parse_args()
+
+    data = generate_accounts(args.accounts, args.seed)
+    if args.transfers:
+        transfers = generate_transfers(data, args.transfers, args.seed)
+        for workers in map(int, args.workers.split(",")):
+            result = measure_transfers(data, transfers, workers)
+            print(f"{workers:>3} workers {result['per_sec']:>12,.0f} transfers/s  {result['settled']} settled")
+        return 0
+    base = None
+    for name, build in LAYOUTS.items():
+        result = measure(build, data)
+        base = base or result["bytes"]
+        print(f"{name:<14} {result['bytes'] / 2 ** 20:>9.1f} MB  {result['bytes'] / len(data):>6.1f} bytes/account  "
+              f"x{base / result['bytes']:.2f} smaller  built in {result['seconds']:.2f}s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,98 +1,2846 @@
 
 import json
+import os
+import gc
+import sys
+import mmap
+import array
+import csv
+import bisect
+import itertools
+import struct
+import time
+import zlib
+import lzma
+import threading
+import functools
+import tempfile
+import collections
+import contextlib
+import heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 #A class to represent a table in the database, including methods for inserting and querying data.
 
 
+# indexes
+## An index maps the values of one column to the positions of the rows holding them. A lookup
+## returns the positions in increasing order, so rows come back in insertion order whether an
+## index answered the query or not.
+
+class HashIndex:
+    kind = "hash"
+
+    def __init__(self, column):
+        self.column = column
+        self.entries = {}
+
+    def add(self, value, position):
+        self.entries.setdefault(value, []).append(position)
+
+    def add_many(self, values, start):
+        # values of the rows at positions start, start + 1, ...
+        entries = self.entries
+        for position, value in enumerate(values, start):
+            entries.setdefault(value, []).append(position)
+
+    def check(self, values):
+        # raises TypeError for a value that can't be a key, before anything is stored
+        for value in values:
+            hash(value)
+
+    def supports(self, op):
+        return op == "=="
+
+    def lookup(self, op, value, count=None, first=None):
+        # positions are added in increasing order, so rows past count are a tail to cut off;
+        # first keeps only that many of the lowest positions
+        positions = self.entries.get(value, [])
+        end = len(positions)
+        if count is not None and positions and positions[-1] >= count:
+            end = bisect.bisect_left(positions, count)
+        return positions[:end if first is None else min(end, first)]
+
+
+class SortedIndex:
+    kind = "sorted"
+
+    def __init__(self, column):
+        self.column = column
+        # (value, position) pairs kept in order, so ranges are found with bisect
+        self.entries = []
+
+    def add(self, value, position):
+        # missing values never satisfy a range, and can't be ordered against the others
+        if value is not None:
+            bisect.insort(self.entries, (value, position))
+
+    def add_many(self, values, start):
+        # sorts the new pairs once and merges them in, instead of one insort per row;
+        # the merged list replaces the old one so readers never see it half sorted
+        pairs = [(value, position) for position, value in enumerate(values, start) if value is not None]
+        pairs.sort()
+        if not pairs:
+            return
+        # only the entries after the first new value have to be merged
+        split = bisect.bisect_left(self.entries, pairs[0])
+        if split == len(self.entries):
+            self.entries.extend(pairs)
+        else:
+            self.entries = self.entries[:split] + sorted(self.entries[split:] + pairs)
+
+    def check(self, values):
+        # raises TypeError for values that can't be ordered with each other or with the indexed
+        # ones, before anything is stored
+        present = [value for value in values if value is not None]
+        if present:
+            for value in (min(present), max(present)):
+                bisect.bisect_left(self.entries, (value,))
+
+    def supports(self, op):
+        return op in ("==", "<", "<=", ">", ">=", "between")
+
+    def lookup(self, op, value, count=None, first=None):
+        if op == "between":
+            low, high = value
+        elif op == "==":
+            low = high = value
+        elif op in ("<", "<="):
+            low, high = None, value
+        else:
+            low, high = value, None
+
+        # add() inserts into the list in place while readers hold no lock, and an insert landing
+        # between the bisects and the slice would shift the range. Entries are only ever added,
+        # so an unchanged length means the list was not touched, otherwise the lookup is redone
+        while True:
+            entries = self.entries
+            size = len(entries)
+            if low is None:
+                start = 0
+            elif op == ">":
+                start = bisect.bisect_right(entries, (low, float("inf")))
+            else:
+                start = bisect.bisect_left(entries, (low,))
+
+            if high is None:
+                end = size
+            elif op == "<":
+                end = bisect.bisect_left(entries, (high,))
+            else:
+                end = bisect.bisect_right(entries, (high, float("inf")))
+
+            found = entries[start:end]
+            if len(entries) == size:
+                break
+        # the entries are in value order; only the rows of one value are already in position order
+        if count is None:
+            positions = [position for _, position in found]
+        else:
+            positions = [position for _, position in found if position < count]
+        if first is not None and first < len(positions):
+            return heapq.nsmallest(first, positions)
+        if op != "==":
+            positions.sort()
+        return positions
+
+
+INDEX_KINDS = {"hash": HashIndex, "sorted": SortedIndex}
+
+
+# where clauses
+## A where clause is a dict of column -> value (equality) or column -> (op, value),
+## e.g. {"position": "Engineer", "id": (">=", 10)} or {"id": ("between", (1, 5))}.
+
+def parse_condition(condition):
+    if isinstance(condition, tuple):
+        op, value = condition
+        if op not in ("==", "!=", "<", "<=", ">", ">=", "between"):
+            raise ValueError(f"Unknown operator {op}")
+        return op, value
+    return "==", condition
+
+
+def matches(value, op, target):
+    if op == "==":
+        return value == target
+    if op == "!=":
+        return value != target
+    if value is None:
+        return False
+    if op == "<":
+        return value < target
+    if op == "<=":
+        return value <= target
+    if op == ">":
+        return value > target
+    if op == ">=":
+        return value >= target
+    low, high = target
+    return low <= value <= high
+
+
+# compiled conditions
+## A where clause is turned once into the source of a lambda testing one row position, e.g.
+##   lambda p: get0(p) == v0 and (x1 := get1(p)) is not None and x1 > v1
+## and compiled with eval, so no per-row dispatch on the operator is left. fetch(number, column)
+## gives the source reading a column; the names it uses are put in namespace by the table.
+## Column names and values never appear in the source, only in namespace.
+
+def compile_conditions(conditions, namespace, fetch, nullable=lambda column: True):
+    parts = []
+    for number, (column, op, value) in enumerate(conditions):
+        namespace[f"v{number}"] = value
+        read = fetch(number, column)
+        if op in ("==", "!="):
+            parts.append(f"{read} {op} v{number}")
+            continue
+        # missing values never satisfy an ordering, as in matches()
+        guard = f"(x{number} := {read}) is not None and " if nullable(column) else ""
+        current = f"x{number}" if guard else read
+        if op == "between":
+            namespace[f"low{number}"], namespace[f"high{number}"] = value
+            parts.append(f"{guard}low{number} <= {current} <= high{number}")
+        else:
+            parts.append(f"{guard}{current} {op} v{number}")
+    return eval(f"lambda p: {' and '.join(parts) or 'True'}", namespace)
+
+
+# column types
+## create_table(..., types={"id": "int", "salary": "float?"}) fixes the type of some columns;
+## a trailing "?" allows missing values. Inserts of anything else fail, except ints going into
+## a float column, which are stored as floats. Columns without a type take any value.
+
+COLUMN_TYPES = {"int": int, "float": float, "str": str, "bool": bool}
+# an index is skipped when its condition is expected to match more than this fraction of the rows
+INDEX_LIMIT = 0.5
+
+
+# ordering
+## select_from(..., order_by="salary") returns the rows by ascending salary, order_by="-salary" by
+## descending salary, and order_by=["position", "-salary"] by several columns. Missing values come
+## last either way, and rows that compare equal keep their insertion order.
+## With a sorted index on the first order_by column the rows are read in index order, which stops
+## as soon as offset + limit of them matched. Otherwise the matching rows are sorted: with a limit
+## only the first offset + limit are kept, in a heap (O(n log k)), and without one a result of more
+## than SORT_RUN_ROWS rows is sorted in runs of that many positions written to temporary files and
+## merged, so iter_select_from(..., order_by=...) streams any number of rows in order.
+
+SORT_RUN_ROWS = 1000000
+
+
+def parse_order(order_by, columns):
+    # "salary" or ["position", "-salary"] -> [("position", False), ("salary", True)]
+    keys = []
+    for name in [order_by] if isinstance(order_by, str) else order_by:
+        column = name[1:] if name.startswith("-") else name
+        if column not in columns:
+            raise ValueError(f"Column {column} does not exist")
+        keys.append((column, name.startswith("-")))
+    return keys
+
+
+class Descending:
+    # reverses the order of one part of a sort key, for order_by mixing both directions
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def sort_parts(keys, values=None):
+    # for each order_by column, a function turning its values into their part of the sort key,
+    # and whether the keys are sorted in reverse. (v is None, v) puts missing values last; when
+    # values shows a column has none, the values themselves are used
+    descending = [flag for _, flag in keys]
+    reverse = all(descending)
+    mixed = any(descending) and not reverse
+    parts = []
+    for number, flag in enumerate(descending):
+        plain = values is not None and None not in values[number]
+        if mixed and flag:
+            parts.append((lambda v: Descending(v)) if plain else
+                         (lambda v: Descending((v is not None, 0 if v is None else v))))
+        elif plain:
+            parts.append(None)
+        elif reverse:
+            parts.append(lambda v: (v is not None, 0 if v is None else v))
+        else:
+            parts.append(lambda v: (v is None, 0 if v is None else v))
+    return parts, reverse
+
+
+def read_run(f, block=65536):
+    # the positions of one sorted run, read back a block at a time
+    f.seek(0)
+    while True:
+        data = f.read(block * 8)
+        if not data:
+            f.close()
+            return
+        yield from array.array('q', data)
+
+
+# aggregation
+## aggregate(group_by=[...], count=True, sum="salary", avg=["salary", "bonus"]) returns one dict
+## per group with the group columns plus "count", "sum_salary", "avg_salary", ...
+## Missing values are skipped, like in SQL. With NumPy installed numeric columns are reduced
+## in one vectorized pass; otherwise (or for non-numeric columns) a single Python loop is used.
+
+AGGREGATES = ("count", "sum", "min", "max", "avg")
+
+
+def parse_aggregates(aggregates):
+    specs = []
+    for function, columns in aggregates.items():
+        if function not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate {function}")
+        if function == "count" and columns is True:
+            specs.append(("count", function, None))
+            continue
+        if not columns:
+            continue
+        for column in [columns] if isinstance(columns, str) else columns:
+            specs.append((f"{function}_{column}", function, column))
+    return specs
+
+
+def aggregate_python(group_by, specs, vectors, count):
+    keys = zip(*(vectors[col] for col in group_by)) if group_by else itertools.repeat((), count)
+    inputs = [vectors[column] if column else itertools.repeat(0, count) for _, _, column in specs]
+    groups = {}
+    for key, values in zip(keys, zip(*inputs) if inputs else itertools.repeat((), count)):
+        state = groups.get(key)
+        if state is None:
+            state = groups[key] = [[0, None] for _ in specs]
+        for (name, function, column), acc, value in zip(specs, state, values):
+            if column and value is None:
+                continue
+            acc[0] += 1
+            if function in ("sum", "avg"):
+                acc[1] = value if acc[1] is None else acc[1] + value
+            elif function == "min":
+                acc[1] = value if acc[1] is None or value < acc[1] else acc[1]
+            elif function == "max":
+                acc[1] = value if acc[1] is None or value > acc[1] else acc[1]
+    if not groups and not group_by:
+        groups[()] = [[0, None] for _ in specs]
+
+    result = []
+    for key, state in groups.items():
+        row = dict(zip(group_by, key))
+        for (name, function, column), (seen, total) in zip(specs, state):
+            if function == "count":
+                row[name] = seen
+            elif function == "avg":
+                row[name] = total / seen if seen else None
+            else:
+                row[name] = total
+        result.append(row)
+    return result
+
+
+def aggregate_numpy(group_by, specs, vectors, keys, count):
+    # vectors holds NumPy arrays for numeric columns; anything else means this path can't be used.
+    # keys maps each group column to (codes, labels): equal values share a code, and
+    # labels[code] is the value (or the codes are the values themselves when labels is None)
+    for _, function, column in specs:
+        if column and not isinstance(vectors[column], numpy.ndarray):
+            return None
+    if count == 0:
+        return aggregate_python(group_by, specs, {col: [] for col in group_by + list(vectors)}, 0)
+
+    if group_by:
+        # combine the group columns into one code per row, keeping the code space no bigger than the table
+        codes = numpy.zeros(count, dtype=numpy.int64)
+        size = 1
+        for col in group_by:
+            column_codes, labels = keys[col]
+            if labels is None:
+                distinct, column_codes = numpy.unique(column_codes, return_inverse=True)
+                column_codes = column_codes.reshape(-1)
+            codes = codes * (len(distinct) if labels is None else len(labels)) + column_codes
+            size *= len(distinct) if labels is None else len(labels)
+            if size > count:
+                distinct, codes = numpy.unique(codes, return_inverse=True)
+                codes = codes.reshape(-1)
+                size = len(distinct)
+        # number the groups in order of first appearance, then sort rows so each group is contiguous
+        first = numpy.full(size, count, dtype=numpy.int64)
+        numpy.minimum.at(first, codes, numpy.arange(count))
+        present = numpy.flatnonzero(first < count)
+        present = present[numpy.argsort(first[present], kind="stable")]
+        rank = numpy.empty(size, dtype=numpy.int64)
+        rank[present] = numpy.arange(len(present))
+        codes = rank[codes]
+        # a stable sort of small integers is a radix sort
+        order = numpy.argsort(codes.astype(numpy.int16) if len(present) < 2 ** 15 else codes, kind="stable")
+        starts = numpy.flatnonzero(numpy.r_[True, codes[order][1:] != codes[order][:-1]])
+        first_rows = first[present]
+    else:
+        order = None
+        starts = numpy.array([0])
+        first_rows = starts
+    sizes = numpy.diff(numpy.r_[starts, count])
+
+    result = [{} for _ in starts]
+    for col in group_by:
+        codes, labels = keys[col]
+        values = codes[first_rows].tolist()
+        for row, value in zip(result, values):
+            row[col] = value if labels is None else labels[value]
+    for name, function, column in specs:
+        if function == "count":
+            values = sizes
+        else:
+            data = vectors[column] if order is None else vectors[column][order]
+            if function in ("sum", "avg"):
+                values = numpy.add.reduceat(data, starts)
+                if function == "avg":
+                    values = values / sizes
+            elif function == "min":
+                values = numpy.minimum.reduceat(data, starts)
+            else:
+                values = numpy.maximum.reduceat(data, starts)
+        for row, value in zip(result, values.tolist()):
+            row[name] = value
+    return result
+
+
 class Table:
+    storage = "rows"
+
     def __init__(self, name):
         self.name = name
-        self.rows = []
         self.columns = []
-        
+        # writers take the lock; readers never do. Writers publish (count, version, dead) in one
+        # assignment: a row only becomes visible once count covers it, and a deleted row stays
+        # visible to readers that captured a version older than its tombstone
+        self.lock = threading.RLock()
+        self.published = (0, 0, 0)
+        self.rows = []
+        self.indexes = {}
+        # tombstones: position -> version that deleted (or replaced) the row
+        self.deleted = {}
+        # set once vacuum() has copied the live rows into a new table
+        self.retired = False
+        # column -> type name, and the (min, max) of typed columns once they are known
+        self.types = {}
+        self.bounds = {}
+        # sequence number of the last logged change applied to this table
+        self.lsn = 0
+
+    def __len__(self):
+        count, version, dead = self.published
+        return count - dead
+
+    @property
+    def count(self):
+        # the number of stored positions, live or deleted
+        return self.published[0]
+
+    @count.setter
+    def count(self, count):
+        self.published = (count,) + self.published[1:]
+
     def set_columns(self, columns):
         self.columns = columns
 
+    def set_types(self, types):
+        for column, kind in types.items():
+            if column not in self.columns:
+                raise ValueError(f"Column {column} does not exist")
+            if kind.rstrip("?") not in COLUMN_TYPES:
+                raise ValueError(f"Unknown type {kind}")
+        self.types = dict(types)
+
+    def typed(self, batch):
+        # checks a batch against the column types; returns it with ints made floats where needed
+        # (the caller's lists are copied rather than changed)
+        copied = False
+        for column, kind in self.types.items():
+            number = self.columns.index(column)
+            expected = COLUMN_TYPES[kind.rstrip("?")]
+            if set(map(type, [values[number] for values in batch])) == {expected}:
+                continue
+            for row, values in enumerate(batch):
+                value = values[number]
+                if type(value) is expected or (value is None and kind.endswith("?")):
+                    continue
+                if expected is float and type(value) is int:
+                    if not copied:
+                        batch, copied = list(batch), True
+                    batch[row] = list(batch[row])
+                    batch[row][number] = float(value)
+                    continue
+                raise ValueError(f"Column {column} expects {kind}, got {value!r}")
+        return batch
+
+    def column_bounds(self, column):
+        # (min, max) of a typed column, kept up to date by inserts; None for untyped columns and ()
+        # while there is no value yet. Deleted rows still count, so the range may be wider than needed
+        if column not in self.types:
+            return None
+        if column not in self.bounds:
+            with self.lock:
+                values = [value for value in self.column_values(column) if value is not None]
+                self.bounds[column] = (min(values), max(values)) if values else ()
+        return self.bounds[column]
+
+    def widen_bounds(self, batch):
+        for column, bounds in list(self.bounds.items()):
+            number = self.columns.index(column)
+            values = [values[number] for values in batch if values[number] is not None]
+            if values:
+                low, high = min(values), max(values)
+                self.bounds[column] = (min(low, bounds[0]), max(high, bounds[1])) if bounds else (low, high)
+
+    def distinct(self, column):
+        # number of distinct values when it is known without a scan
+        index = self.indexes.get(column)
+        return len(index.entries) if index is not None and index.kind == "hash" else None
+
+    def selectivity(self, column, op, value):
+        # the expected fraction of rows matching one condition, from the column's bounds and
+        # distinct values; 0 only when no row can match
+        bounds = self.column_bounds(column)
+        try:
+            if op in ("==", "!="):
+                if value is not None and bounds is not None and (not bounds or not bounds[0] <= value <= bounds[1]):
+                    equal = 0
+                else:
+                    equal = 1 / (self.distinct(column) or 10)
+                # missing values match != too, so it is never ruled out
+                return equal if op == "==" else max(1 - equal, 0.01)
+            if bounds is None or value is None:
+                return 1 / 3
+            if not bounds:
+                return 0
+            low, high = value if op == "between" else (value, None) if op in (">", ">=") else (None, value)
+            if (high is not None and (high < bounds[0] or op == "<" and high == bounds[0])) or \
+                    (low is not None and (low > bounds[1] or op == ">" and low == bounds[1])):
+                return 0
+            if not all(isinstance(bound, (int, float)) for bound in bounds + (low or 0, high or 0)):
+                return 1 / 3
+            if bounds[1] == bounds[0]:
+                return 1
+            covered = min(bounds[1] if high is None else high, bounds[1]) - max(bounds[0] if low is None else low, bounds[0])
+            return min(1, max(covered / (bounds[1] - bounds[0]), 0.001))
+        except TypeError:
+            # a value that can't be compared with the column's
+            return 1 / 3
+
+    def compile(self, conditions):
+        # a function of a row position testing every condition
+        namespace = {"rows": self.rows}
+        for number, (column, op, value) in enumerate(conditions):
+            namespace[f"c{number}"] = column
+        return compile_conditions(conditions, namespace, lambda number, column: f"rows[p].get(c{number})",
+                                  self.nullable)
+
+    def nullable(self, column):
+        # untyped columns and types ending in "?" may hold missing values
+        kind = self.types.get(column)
+        return kind is None or kind.endswith("?")
+
+    def append(self, values):
+        # stores one already validated row and returns its position
+        self.rows.append(dict(zip(self.columns, values)))
+        return len(self.rows) - 1
+
+    def value(self, position, column):
+        return self.rows[position].get(column, None)
+
+    def column_values(self, column, count=None):
+        # the raw values of the first count positions, deleted rows included
+        count = self.count if count is None else count
+        return [row.get(column, None) for row in itertools.islice(self.rows, count)]
+
     def insert(self, values):
         if len(values) != len(self.columns):
             raise ValueError("The number of values does not match the number of columns")
-        self.rows.append(dict(zip(self.columns, values)))
+        if self.types:
+            values = self.typed([values])[0]
+        with self.lock:
+            # every index checks its value before the row is stored (see check_indexes)
+            indexed = [(index, values[self.columns.index(column)]) for column, index in self.indexes.items()]
+            for index, value in indexed:
+                index.check((value,))
+            position = self.append(values)
+            for index, value in indexed:
+                index.add(value, position)
+            if self.bounds:
+                self.widen_bounds([values])
+            self.count = position + 1
 
-    def select(self, *columns):
+    def create_index(self, column, kind="hash"):
+        if column not in self.columns:
+            raise ValueError(f"Column {column} does not exist")
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"Unknown index kind {kind}")
+        with self.lock:
+            index = INDEX_KINDS[kind](column)
+            index.add_many(self.column_values(column), 0)
+            self.indexes[column] = index
+
+    def insert_many(self, rows, batch_size=10000):
+        # inserts an iterable of value lists batch by batch: the schema is checked once per batch,
+        # values are appended column by column and indexes are updated at the end of each batch
+        rows = iter(rows)
+        total = 0
+        width = len(self.columns)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return total
+            if set(map(len, batch)) != {width}:
+                raise ValueError("The number of values does not match the number of columns")
+            if self.types:
+                batch = self.typed(batch)
+            with self.lock:
+                self.count = self.store(batch)
+            total += len(batch)
+
+    def check_indexes(self, batch):
+        # a value an index can't take fails the whole insert before any row is stored, so a row
+        # is never stored without being indexed
+        for column, index in self.indexes.items():
+            number = self.columns.index(column)
+            index.check([values[number] for values in batch])
+
+    def store(self, batch):
+        # appends a batch and indexes it without publishing it; returns the new count
+        self.check_indexes(batch)
+        start = self.count
+        self.extend(batch)
+        for column, index in self.indexes.items():
+            number = self.columns.index(column)
+            index.add_many([values[number] for values in batch], start)
+        if self.bounds:
+            self.widen_bounds(batch)
+        return start + len(batch)
+
+    def extend(self, batch):
+        # stores a batch of already validated rows after the existing ones
+        columns = self.columns
+        self.rows.extend([dict(zip(columns, values)) for values in batch])
+
+    def update(self, where, set):
+        # replaces the matching rows by new versions with the columns in set changed: the new rows
+        # are appended and indexed, and the old ones get a tombstone, all published together
+        for column in set:
+            if column not in self.columns:
+                raise ValueError(f"Column {column} does not exist")
+        with self.lock:
+            positions = self.find(where)
+            count, version, dead = self.published
+            batch = [[set[col] if col in set else self.value(position, col) for col in self.columns]
+                     for position in positions]
+            if self.types:
+                batch = self.typed(batch)
+            count = self.store(batch)
+            for position in positions:
+                self.deleted[position] = version + 1
+            self.published = (count, version + 1, dead + len(positions))
+        return len(positions)
+
+    def delete(self, where=None):
+        # marks the matching rows deleted; their space is reclaimed by vacuum()
+        with self.lock:
+            positions = self.find(where)
+            count, version, dead = self.published
+            for position in positions:
+                self.deleted[position] = version + 1
+            self.published = (count, version + 1, dead + len(positions))
+        return len(positions)
+
+    def visible(self, positions, version=None, lazy=False):
+        # drops the positions deleted at or before version; lazy=True filters them as they are
+        # iterated instead of collecting a list, so a full scan stays flat in memory
+        deleted = self.deleted
+        if not deleted:
+            return positions
+        version = self.published[1] if version is None else version
+        if lazy:
+            return (position for position in positions if deleted.get(position, version + 1) > version)
+        return [position for position in positions if deleted.get(position, version + 1) > version]
+
+    def vacuum(self):
+        # returns a copy of the table holding only the live rows, with its indexes rebuilt;
+        # this table is marked retired so writers move on to the copy
+        with self.lock:
+            table = STORAGE_KINDS[self.storage](self.name)
+            table.set_columns(self.columns)
+            table.set_types(self.types)
+            positions = self.find()
+            table.insert_many([[self.value(p, col) for col in self.columns] for p in positions], len(positions) or 1)
+            for column, index in self.indexes.items():
+                table.create_index(column, index.kind)
+            table.lsn = self.lsn
+            self.retired = True
+        return table
+
+    def plan(self, where, scan=True, lazy=False, wanted=None):
+        # returns the candidate positions for where and the conditions still to be checked on them;
+        # scan=False skips the column scan when no index applies (the candidates are then every row),
+        # lazy=True returns them as an iterator when rows have been deleted, and wanted (offset + limit)
+        # lets an index that answers the whole where clause return only the first rows
+        count, version, dead = self.published
+        if not where:
+            if scan:
+                note("rows_scanned", count)
+            return self.visible(range(count), version, lazy), []
+        conditions = []
+        for column, condition in where.items():
+            if column not in self.columns:
+                raise ValueError(f"Column {column} does not exist")
+            op, value = parse_condition(condition)
+            conditions.append((column, op, value))
+
+        # the most selective conditions go first; one that the column bounds rule out empties the result
+        ranked = sorted((self.selectivity(*condition), number, condition) for number, condition in enumerate(conditions))
+        if ranked[0][0] == 0:
+            return [], []
+        conditions = [condition for _, _, condition in ranked]
+
+        # use an index for the most selective condition that has one (hash lookups first on a tie),
+        # unless it would return most of the table anyway; the rest are checked row by row
+        indexed = None
+        best = None
+        for estimate, number, (column, op, value) in ranked:
+            index = self.indexes.get(column)
+            if index and index.supports(op) and value is not None and estimate <= INDEX_LIMIT:
+                if best is None or (estimate, index.kind != "hash") < best:
+                    indexed, best = (column, op, value), (estimate, index.kind != "hash")
+
+        if indexed:
+            column, op, value = indexed
+            conditions.remove(indexed)
+            # with nothing left to check, the first wanted positions are enough; taking dead more
+            # makes up for deleted rows among them
+            first = wanted + dead if wanted is not None and not conditions else None
+            candidates = self.indexes[column].lookup(op, value, count, first)
+            if scan:
+                note("rows_scanned", len(candidates))
+                note_index(self.name, column)
+        elif scan:
+            candidates = self.scan(conditions, count)
+            note("rows_scanned", count)
+            note("full_scans")
+        else:
+            candidates = range(count)
+        return self.visible(candidates, version, lazy), conditions
+
+    def scan(self, conditions, count):
+        # the candidates when no index applies: every row, checked one by one afterwards
+        return range(count)
+
+    def estimate(self, where=None):
+        # rough number of rows matching where, used to choose join strategies:
+        # exact when an index answers it, otherwise scaled by each other condition's selectivity
+        candidates, conditions = self.plan(where, scan=False)
+        estimate = len(candidates)
+        for condition in conditions:
+            estimate *= self.selectivity(*condition)
+        return int(estimate)
+
+    def check(self, position, conditions):
+        return all(matches(self.value(position, column), op, value) for column, op, value in conditions)
+
+    def find(self, where=None, limit=None, offset=0, order_by=None):
+        # returns the positions of the rows matching every condition in where
+        if order_by:
+            return list(self.ordered(where, order_by, limit, offset))
+        # offset and limit count matching rows in insertion order, whichever plan found them
+        candidates, conditions = self.plan(where, wanted=None if limit is None else offset + limit)
+        if conditions:
+            test = self.compile(conditions)
+            candidates = [position for position in candidates if test(position)]
+        if offset or limit is not None:
+            candidates = candidates[offset:None if limit is None else offset + limit]
+        return candidates
+
+    def iter_find(self, where=None, limit=None, offset=0, order_by=None):
+        # like find, but yields positions one at a time so nothing is collected up front
+        if order_by:
+            return iter(self.ordered(where, order_by, limit, offset))
+        candidates, conditions = self.plan(where, lazy=True, wanted=None if limit is None else offset + limit)
+        if conditions:
+            candidates = filter(self.compile(conditions), candidates)
+        if offset or limit is not None:
+            candidates = itertools.islice(candidates, offset, None if limit is None else offset + limit)
+        return iter(candidates)
+
+    def ordered(self, where, order_by, limit=None, offset=0):
+        # the positions matching where in the order of order_by (see "ordering")
+        keys = parse_order(order_by, self.columns)
+        count = self.count
+        wanted = None if limit is None else offset + limit
+        index = self.indexes.get(keys[0][0])
+        if index is not None and index.kind == "sorted":
+            # reading the index passes about wanted * count / matching entries; sorting costs the
+            # matching rows, so the index is only read when it is expected to stop sooner
+            matching = self.estimate(where) if where else count
+            if matching and matching * matching >= min(wanted or count, matching) * count:
+                return self.walk(index, keys, where, wanted)[offset:wanted]
+        # a sorted index returns positions in value order; equal rows must stay in insertion order
+        positions = sorted(self.find(where))
+        if len(positions) > SORT_RUN_ROWS and (wanted is None or wanted > SORT_RUN_ROWS):
+            return itertools.islice(self.sort_runs(positions, keys), offset, wanted)
+        return self.order(positions, keys, wanted)[offset:wanted]
+
+    def walk(self, index, keys, where, wanted=None):
+        # the positions matching where in the order of a sorted index on the first key, stopping after wanted
+        # of them. insert() changes the entries in place, so a short walk holds the lock, a full one copies them
+        count, version, dead = self.published
+        conditions = [(column, *parse_condition(condition)) for column, condition in (where or {}).items()]
+        test = self.compile(conditions) if conditions else None
+        deleted = self.deleted
+        column, descending = keys[0]
+        note_index(self.name, column)
+        if wanted is None:
+            with self.lock:
+                entries = index.entries[:]
+            lock = contextlib.nullcontext()
+        else:
+            entries = index.entries
+            lock = self.lock
         result = []
-        for row in self.rows:
+        with lock:
+            # the entries are read in chunks that never split a run of equal values; each chunk is
+            # in (value, position) order already, and only needs sorting for the other keys or descending
+            size = max(wanted or 0, 1024)
+            low, high = 0, len(entries)
+            while low < high and (wanted is None or len(result) < wanted):
+                if descending:
+                    start = bisect.bisect_left(entries, (entries[max(high - size, low)][0],), low, high)
+                    chunk, high = entries[start:high], start
+                else:
+                    end = bisect.bisect_right(entries, (entries[min(low + size, high) - 1][0], float("inf")), low, high)
+                    chunk, low = entries[low:end], end
+                if descending and not keys[1:]:
+                    # equal values keep their positions in increasing order
+                    chunk.sort(key=lambda entry: entry[0], reverse=True)
+                positions = [position for _, position in chunk if position < count]
+                note("rows_scanned", len(positions))
+                if deleted:
+                    positions = [position for position in positions if deleted.get(position, version + 1) > version]
+                if test is not None:
+                    positions = [position for position in positions if test(position)]
+                if keys[1:]:
+                    positions = self.order(positions, keys, None if wanted is None else wanted - len(result))
+                result += positions
+                size = min(size * 2, 1 << 20)
+            # rows whose value is missing are not in the index; they can only exist when it has fewer entries than rows
+            if (wanted is None or len(result) < wanted) and len(entries) < count:
+                missing = [position for position in sorted(self.find(where)) if self.value(position, column) is None]
+                result += self.order(missing, keys[1:]) if keys[1:] else missing
+        return result
+
+    def values_at(self, column, positions):
+        rows = self.rows
+        return [rows[position].get(column) for position in positions]
+
+    def order(self, positions, keys, wanted=None):
+        # positions sorted by keys; with wanted only the first wanted of them, kept in a heap
+        values = [self.values_at(column, positions) for column, _ in keys]
+        parts, reverse = sort_parts(keys, values)
+        columns = [values[number] if part is None else list(map(part, values[number]))
+                   for number, part in enumerate(parts)]
+        sort_keys = columns[0] if len(columns) == 1 else list(zip(*columns))
+        if wanted is not None and wanted < len(positions):
+            select = heapq.nlargest if reverse else heapq.nsmallest
+            numbers = select(wanted, range(len(positions)), key=sort_keys.__getitem__)
+        else:
+            numbers = sorted(range(len(positions)), key=sort_keys.__getitem__, reverse=reverse)
+        return [positions[number] for number in numbers]
+
+    def sort_runs(self, positions, keys):
+        # an external merge sort: runs of SORT_RUN_ROWS sorted positions go to temporary files
+        # and are merged back, reading each key again from the table
+        runs = []
+        for start in range(0, len(positions), SORT_RUN_ROWS):
+            f = tempfile.TemporaryFile()
+            f.write(array.array('q', self.order(positions[start:start + SORT_RUN_ROWS], keys)).tobytes())
+            runs.append(f)
+        del positions
+        parts, reverse = sort_parts(keys)
+
+        def sort_key(position):
+            return tuple(part(self.value(position, column)) for part, (column, _) in zip(parts, keys))
+        return heapq.merge(*map(read_run, runs), key=sort_key, reverse=reverse)
+
+    def rows_at(self, positions, columns):
+        result = []
+        for position in positions:
+            row = self.rows[position]
             result_row = {col: row.get(col, None) for col in columns}
             result.append(result_row)
         return result
 
-    def to_dict(self):
+    def select(self, *columns, where=None, limit=None, offset=0, order_by=None):
+        return self.rows_at(self.find(where, limit, offset, order_by), columns)
+
+    def iter_select(self, *columns, where=None, limit=None, offset=0, batch_size=None, order_by=None):
+        # yields matching rows one by one, or lists of up to batch_size rows
+        positions = self.iter_find(where, limit, offset, order_by)
+        while True:
+            batch = list(itertools.islice(positions, batch_size or 1))
+            if not batch:
+                return
+            rows = self.rows_at(batch, columns)
+            if batch_size:
+                yield rows
+            else:
+                yield rows[0]
+
+    def project(self, *columns, where=None, limit=None, offset=0, order_by=None):
+        # like select, but returns one list per column instead of one dict per row
+        positions = self.find(where, limit, offset, order_by)
+        return {col: [self.value(position, col) for position in positions] for col in columns}
+
+    def vector(self, column, positions=None, count=None):
+        # the values of one column (of the given rows, or the first count), as a NumPy array when they are all numbers
+        values = self.column_values(column, count) if positions is None else [self.value(p, column) for p in positions]
+        if numpy is not None and values and {type(value) for value in values} in ({int}, {float}):
+            try:
+                return numpy.array(values)
+            except OverflowError:
+                pass
+        return values
+
+    def group_codes(self, column, positions=None, count=None):
+        values = self.vector(column, positions, count)
+        if isinstance(values, numpy.ndarray):
+            return values, None
+        labels = {}
+        codes = [labels.setdefault(value, len(labels)) for value in values]
+        return numpy.array(codes, dtype=numpy.int64), list(labels)
+
+    def aggregate(self, group_by=(), where=None, **aggregates):
+        specs = parse_aggregates(aggregates)
+        for column in list(group_by) + [column for _, _, column in specs if column]:
+            if column not in self.columns:
+                raise ValueError(f"Column {column} does not exist")
+        count = self.count
+        positions = self.find(where) if where or self.deleted else None
+        rows = count if positions is None else len(positions)
+        needed = set(group_by) | {column for _, _, column in specs if column}
+        if numpy is not None:
+            vectors = {column: self.vector(column, positions, count) for _, _, column in specs if column}
+            if all(isinstance(values, numpy.ndarray) for values in vectors.values()):
+                keys = {col: self.group_codes(col, positions, count) for col in group_by}
+                return aggregate_numpy(list(group_by), specs, vectors, keys, rows)
+        if positions is None:
+            vectors = {col: self.column_values(col, count) for col in needed}
+        else:
+            vectors = {col: [self.value(p, col) for p in positions] for col in needed}
+        return aggregate_python(list(group_by), specs, vectors, rows)
+
+    def snapshot(self):
+        # the row count, version and log position of the table at one moment, for saving without stopping writers
+        with self.lock:
+            return self.count, self.published[1], self.lsn
+
+    def index_kinds(self):
+        return {column: index.kind for column, index in self.indexes.items()}
+
+    def live(self, snapshot):
+        # the positions a saved snapshot holds, or None when no row was deleted
+        count, version, lsn = snapshot
+        return self.visible(range(count), version) if self.deleted else None
+
+    def to_dict(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        count, version, lsn = snapshot
+        positions = self.live(snapshot)
         return {
             "columns": self.columns,
-            "rows": self.rows
+            "rows": self.rows[:count] if positions is None else [self.rows[p] for p in positions],
+            "indexes": self.index_kinds(),
+            "types": self.types,
+            "lsn": lsn
         }
 
     @classmethod
-    def from_dict(cls, data):
-        table = cls(name="unknown")
+    def from_dict(cls, data, name="unknown"):
+        if cls is Table:
+            cls = STORAGE_KINDS[data.get("storage", "rows")]
+        table = cls(name=name)
         table.columns = data["columns"]
-        table.rows = data["rows"]
+        table.set_types(data.get("types", {}))
+        table.load_data(data)
+        for column, kind in data.get("indexes", {}).items():
+            table.create_index(column, kind)
+        table.lsn = data.get("lsn", 0)
         return table
+
+    def load_data(self, data):
+        self.rows = data["rows"]
+        self.count = len(self.rows)
+
+
+# columnar storage
+## A column keeps its values in one typed container instead of one dict entry per row:
+## ints and floats in an array.array, strings as codes into a dictionary of distinct values,
+## anything else in a plain list. Missing values are remembered in a set of positions
+## (a mapped column reads them from per-page bitmaps instead, see PageNulls).
+
+class Column:
+    def __init__(self, values=()):
+        self.kind = None
+        self.values = []
+        self.nulls = set()
+        self.dictionary = None
+        self.codes = None
+        for value in values:
+            if not self.append(value):
+                vars(self).update(vars(self.widened(value)))
+                self.append(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, value):
+        # returns False, without changing anything, when the value doesn't fit this column's container
+        if value is None:
+            if self.kind not in (None, "object"):
+                self.nulls.add(len(self.values))
+                self.values.append(0)
+                return True
+            self.values.append(None)
+            return True
+        kind = type(value)
+        if self.kind == "object":
+            self.values.append(value)
+        elif self.kind == "str" and kind is str:
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.dictionary)
+                self.dictionary.append(value)
+            self.values.append(code)
+        elif self.kind == kind.__name__ and self.kind != "str":
+            try:
+                self.values.append(value)
+            except OverflowError:
+                return False
+        else:
+            return False
+        return True
+
+    def widened(self, value):
+        # a new column holding the same values in a container that can also take value:
+        # picked from the first non-missing value, or a plain list once the types disagree.
+        # Readers keep using the old column object, which is never changed afterwards.
+        column = Column()
+        nulls = len(self.values)
+        kind = type(value)
+        if self.kind is None and kind is int:
+            column.kind, column.values = "int", array.array("q", bytes(8 * nulls))
+        elif self.kind is None and kind is float:
+            column.kind, column.values = "float", array.array("d", bytes(8 * nulls))
+        elif self.kind is None and kind is str:
+            column.kind, column.values = "str", array.array("i", bytes(4 * nulls))
+            column.dictionary, column.codes = [], {}
+        else:
+            column.kind, column.values = "object", self.to_list()
+            return column
+        column.nulls = set(range(nulls))
+        return column
+
+    def extend(self, values):
+        # appends values until one doesn't fit and returns how many were appended
+        types = set(map(type, values))
+        if self.kind == "object":
+            self.values.extend(values)
+            return len(values)
+        if self.kind in ("int", "float") and types == {int if self.kind == "int" else float}:
+            try:
+                # built separately first, so an overflow leaves the column untouched
+                self.values.extend(array.array(self.values.typecode, values))
+                return len(values)
+            except OverflowError:
+                pass
+        elif self.kind == "str" and types == {str}:
+            codes, dictionary = self.codes, self.dictionary
+            new = []
+            for value in values:
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(dictionary)
+                    dictionary.append(value)
+                new.append(code)
+            self.values.extend(array.array("i", new))
+            return len(values)
+        for done, value in enumerate(values):
+            if not self.append(value):
+                return done
+        return len(values)
+
+    def materialize(self):
+        # in-memory columns already hold their values
+        pass
+
+    def array(self, count=None):
+        # a copy of the first count values (codes for strings) in their typed array
+        return self.values[:count]
+
+    def stored_pages(self, count):
+        # (first position, stored values) pieces covering the first count values
+        yield 0, self.values[:count]
+
+    def filter(self, op, target, count=None):
+        # the positions below count whose value matches; a string condition is decided once per
+        # distinct string and then tested on the codes, and a run of equal values is tested once
+        count = len(self) if count is None else count
+        if self.kind not in TYPECODES:
+            return [position for position, value in enumerate(self.to_list(count)) if matches(value, op, target)]
+        test = (op, target)
+        if self.kind == "str":
+            self.load_dictionary()
+            test = ("in", {code for code, value in enumerate(self.dictionary) if matches(value, op, target)})
+        result = []
+        for start, piece in self.stored_pages(count):
+            result.extend(filter_stored(piece, *test, start))
+        nulls = {position for position in list(self.nulls) if position < count}
+        if nulls:
+            # missing values are stored as 0, so they are decided separately
+            result = [position for position in result if position not in nulls]
+            if matches(None, op, target):
+                result = sorted(result + list(nulls))
+        return result
+
+    def load_dictionary(self):
+        # in-memory columns already hold their dictionary
+        pass
+
+    def encoded_pages(self, count=None):
+        # (row count, bytes, encoding, compression) for each page of the binary file format
+        count = len(self.values) if count is None else count
+        for start in range(0, count, PAGE_ROWS):
+            page = self.values[start:min(start + PAGE_ROWS, count)]
+            if self.kind in TYPECODES:
+                encoding, data = encode_page(page, self.kind)
+                yield len(page), data, encoding, None
+            else:
+                yield len(page), json.dumps(page).encode(), "json", None
+
+    def get(self, position):
+        if self.nulls and position in self.nulls:
+            return None
+        if self.kind == "str":
+            return self.dictionary[self.values[position]]
+        return self.values[position]
+
+    def take(self, positions):
+        return [self.get(position) for position in positions]
+
+    def to_list(self, count=None):
+        # the first count values (all of them by default)
+        values = self.values if count is None else self.values[:count]
+        if self.kind == "str":
+            dictionary = self.dictionary
+            result = [dictionary[code] for code in values]
+        else:
+            result = list(values)
+        for position in list(self.nulls):
+            if position < len(result):
+                result[position] = None
+        return result
+
+
+class ColumnTable(Table):
+    storage = "columns"
+
+    @property
+    def rows(self):
+        # rows are only built when someone asks for them
+        if self.deleted:
+            return self.rows_at(self.find(), self.columns)
+        count = self.count
+        return [dict(zip(self.columns, values))
+                for values in zip(*(self.data[col].to_list(count) for col in self.columns))]
+
+    @rows.setter
+    def rows(self, rows):
+        self.data = {col: Column() for col in self.columns}
+        self.deleted = {}
+        self.published = (0, 0, 0)
+        for row in rows:
+            self.append([row.get(col, None) for col in self.columns])
+            self.count += 1
+
+    def set_columns(self, columns):
+        self.columns = columns
+        self.rows = []
+
+    def append(self, values):
+        for col, value in zip(self.columns, values):
+            column = self.data[col]
+            if not column.append(value):
+                column = column.widened(value)
+                column.append(value)
+                self.data[col] = column
+        return len(self.data[self.columns[0]]) - 1
+
+    def extend(self, batch):
+        for number, col in enumerate(self.columns):
+            values = [row[number] for row in batch]
+            column = self.data[col]
+            done = column.extend(values)
+            while done < len(values):
+                column = column.widened(values[done])
+                self.data[col] = column
+                done += column.extend(values[done:])
+
+    def value(self, position, column):
+        column = self.data.get(column)
+        return column.get(position) if column is not None else None
+
+    def compile(self, conditions):
+        namespace = {}
+        for number, (column, op, value) in enumerate(conditions):
+            column = self.data.get(column)
+            namespace[f"get{number}"] = column.get if column is not None else lambda position: None
+        return compile_conditions(conditions, namespace, lambda number, column: f"get{number}(p)", self.nullable)
+
+    def distinct(self, column):
+        data = self.data.get(column)
+        if data is not None and data.kind == "str" and not data.nulls:
+            data.load_dictionary()
+            return len(data.dictionary)
+        return super().distinct(column)
+
+    def scan(self, conditions, count):
+        # without an index the first condition is evaluated a whole column at a time,
+        # on the stored codes and runs rather than on decoded values
+        column, op, value = conditions.pop(0)
+        return self.data[column].filter(op, value, count)
+
+    def column_values(self, column, count=None):
+        return self.data[column].to_list(self.count if count is None else count)
+
+    def project(self, *columns, where=None, limit=None, offset=0, order_by=None):
+        if not where and not offset and limit is None and not self.deleted and not order_by:
+            count = self.count
+            return {col: self.column_values(col, count) if col in self.data else [None] * count for col in columns}
+        positions = self.find(where, limit, offset, order_by)
+        return {col: self.data[col].take(positions) if col in self.data else [None] * len(positions) for col in columns}
+
+    def select(self, *columns, where=None, limit=None, offset=0, order_by=None):
+        if not columns:
+            return [{} for _ in self.find(where, limit, offset, order_by)]
+        projected = self.project(*columns, where=where, limit=limit, offset=offset, order_by=order_by)
+        return [dict(zip(columns, values)) for values in zip(*(projected[col] for col in columns))]
+
+    def vector(self, column, positions=None, count=None):
+        data = self.data[column]
+        if numpy is None or data.kind not in ("int", "float") or data.nulls:
+            return super().vector(column, positions, count)
+        # the array is copied first: a NumPy view would stop concurrent inserts from growing it
+        values = numpy.frombuffer(data.array(self.count if count is None else count),
+                                  dtype=numpy.int64 if data.kind == "int" else numpy.float64)
+        return values if positions is None else values[numpy.asarray(positions, dtype=numpy.int64)]
+
+    def group_codes(self, column, positions=None, count=None):
+        data = self.data[column]
+        if data.kind != "str" or data.nulls:
+            return super().group_codes(column, positions, count)
+        # strings are already stored as codes into the column's dictionary
+        codes = numpy.frombuffer(data.array(self.count if count is None else count), dtype=numpy.int32)
+        return (codes if positions is None else codes[numpy.asarray(positions, dtype=numpy.int64)]), data.dictionary
+
+    def values_at(self, column, positions):
+        return self.data[column].take(positions) if column in self.data else [None] * len(positions)
+
+    def rows_at(self, positions, columns):
+        if not columns:
+            return [{} for _ in positions]
+        taken = [self.data[col].take(positions) if col in self.data else [None] * len(positions) for col in columns]
+        return [dict(zip(columns, values)) for values in zip(*taken)]
+
+    def to_dict(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        count, version, lsn = snapshot
+        positions = self.live(snapshot)
+        return {
+            "columns": self.columns,
+            "storage": self.storage,
+            "data": {col: self.data[col].to_list(count) if positions is None else self.data[col].take(positions)
+                     for col in self.columns},
+            "indexes": self.index_kinds(),
+            "types": self.types,
+            "lsn": lsn
+        }
+
+    def load_data(self, data):
+        self.data = {col: Column(data["data"][col]) for col in self.columns}
+        self.count = len(self.data[self.columns[0]]) if self.columns else 0
+
+
+STORAGE_KINDS = {"rows": Table, "columns": ColumnTable}
+
+
+# binary file format
+## header: magic, offset and length of the directory
+## body: every column of every table cut into pages of PAGE_ROWS values
+##       (raw array bytes for ints, floats and string codes, JSON for anything else), each page
+##       followed by a zlib compressed bitmap of its missing values when it has any
+## directory: JSON describing each table and where its column pages and string dictionaries live
+## The file is opened with mmap and a page (or its bitmap) is only decoded the first time a row
+## on it is read.
+
+MAGIC = b"SDB1"
+HEADER = struct.Struct("<4sQQ")
+PAGE_ROWS = 65536
+TYPECODES = {"int": "q", "float": "d", "str": "i"}
+
+
+# page encodings
+## Each page of ints, floats or string codes is written in whichever of these is smallest:
+##   plain     the array bytes
+##   rle       the run values followed by the run lengths, for pages with long runs of one value
+##   delta:b   ints as the first value then the differences in 1, 2 or 4 bytes (delta:h, delta:i)
+##   narrow:B  string codes in 1 or 2 bytes (narrow:H) when the dictionary is small
+## Pages and dictionaries may also be compressed with zlib or lzma (write_binary's compression).
+## Filters read rle pages without expanding them; see Column.filter.
+
+COMPRESSORS = {"zlib": (zlib.compress, zlib.decompress), "lzma": (lzma.compress, lzma.decompress)}
+
+
+def runs_of(values):
+    # the start of every run of equal values
+    if numpy is not None and len(values) > 1:
+        stored = numpy.frombuffer(values, dtype=values.typecode)
+        return [0] + (numpy.flatnonzero(stored[1:] != stored[:-1]) + 1).tolist()
+    return [position for position in range(len(values)) if position == 0 or values[position] != values[position - 1]]
+
+
+def encode_page(values, kind):
+    # returns (encoding, bytes) for one page of an array
+    encodings = [("plain", values.tobytes())]
+    starts = runs_of(values)
+    if len(starts) * (values.itemsize + 4) < len(values) * values.itemsize // 2:
+        ends = starts[1:] + [len(values)]
+        runs = array.array(values.typecode, [values[start] for start in starts])
+        lengths = array.array("I", [end - start for start, end in zip(starts, ends)])
+        encodings.append(("rle", runs.tobytes() + lengths.tobytes()))
+    if kind == "int" and len(values) > 1 and -2 ** 62 < min(values) and max(values) < 2 ** 62:
+        deltas = [b - a for a, b in zip(values, values[1:])] if numpy is None else \
+            numpy.diff(numpy.frombuffer(values, dtype=numpy.int64)).tolist()
+        low, high = min(deltas), max(deltas)
+        for typecode, limit in (("b", 2 ** 7), ("h", 2 ** 15), ("i", 2 ** 31)):
+            if -limit <= low and high < limit:
+                encodings.append((f"delta:{typecode}", values[:1].tobytes() + array.array(typecode, deltas).tobytes()))
+                break
+    if kind == "str" and values:
+        highest = max(values)
+        for typecode, limit in (("B", 2 ** 8), ("H", 2 ** 16)):
+            if highest < limit:
+                encodings.append((f"narrow:{typecode}", array.array(typecode, values).tobytes()))
+                break
+    return min(encodings, key=lambda encoding: len(encoding[1]))
+
+
+def typed(typecode, data, swap):
+    values = array.array(typecode)
+    values.frombytes(data)
+    if swap:
+        values.byteswap()
+    return values
+
+
+def decode_runs(data, kind, swap):
+    # the run values and run lengths of an rle page
+    typecode = TYPECODES[kind]
+    size = array.array(typecode).itemsize
+    runs = len(data) // (size + 4)
+    return typed(typecode, data[:runs * size], swap), typed("I", data[runs * size:], swap)
+
+
+def decode_page(data, kind, encoding, swap=False):
+    typecode = TYPECODES[kind]
+    if encoding == "plain":
+        return typed(typecode, data, swap)
+    if encoding == "rle":
+        runs, lengths = decode_runs(data, kind, swap)
+        if numpy is not None:
+            return array.array(typecode, numpy.repeat(numpy.frombuffer(runs, dtype=typecode), lengths).tobytes())
+        values = array.array(typecode)
+        for value, length in zip(runs, lengths):
+            values.extend(array.array(typecode, [value]) * length)
+        return values
+    encoding, narrow = encoding.split(":")
+    if encoding == "narrow":
+        return array.array(typecode, typed(narrow, data, swap))
+    first = typed("q", data[:8], swap)[0]
+    return array.array(typecode, itertools.accumulate(typed(narrow, data[8:], swap), initial=first))
+
+
+def filter_stored(piece, op, target, start):
+    # positions (from start) of the stored values in piece that match op and target; piece is an
+    # array, or (run values, run lengths) for a page that is still run-length encoded.
+    # op "in" tests membership of a set of string codes
+    if isinstance(piece, tuple):
+        runs, lengths = piece
+        offsets = list(itertools.accumulate(lengths, initial=start))
+        return [position for run in filter_stored(runs, op, target, 0)
+                for position in range(offsets[run], offsets[run + 1])]
+    numeric = isinstance(target, (int, float)) or \
+        (op == "between" and all(isinstance(value, (int, float)) for value in target))
+    if numpy is not None and piece and (op == "in" or numeric):
+        values = numpy.frombuffer(piece, dtype=piece.typecode)
+        try:
+            if op == "in":
+                mask = numpy.isin(values, numpy.fromiter(target, dtype=numpy.int64, count=len(target)))
+            elif op == "between":
+                mask = (values >= target[0]) & (values <= target[1])
+            else:
+                mask = {"==": values.__eq__, "!=": values.__ne__, "<": values.__lt__, "<=": values.__le__,
+                        ">": values.__gt__, ">=": values.__ge__}[op](target)
+            return (numpy.flatnonzero(mask) + start).tolist()
+        except OverflowError:
+            pass
+    if op == "in":
+        return [start + position for position, value in enumerate(piece) if value in target]
+    return [start + position for position, value in enumerate(piece) if matches(value, op, target)]
+
+
+def null_bitmap(offsets, rows):
+    # one bit per row of a page, set for the missing values at offsets
+    bits = bytearray((rows + 7) // 8)
+    for offset in offsets:
+        bits[offset >> 3] |= 1 << (offset & 7)
+    return bytes(bits)
+
+
+def bitmap_positions(bitmap, start):
+    # the positions of the set bits, counted from start
+    if numpy is not None:
+        bits = numpy.unpackbits(numpy.frombuffer(bitmap, dtype=numpy.uint8), bitorder="little")
+        return (numpy.flatnonzero(bits) + start).tolist()
+    return [start + 8 * number + bit for number, byte in enumerate(bitmap) if byte
+            for bit in range(8) if byte >> bit & 1]
+
+
+def write_binary(f, tables, snapshots=None, compression=None):
+    # snapshots maps table names to the (row count, version, lsn) to write; by default everything is written.
+    # compression ("zlib" or "lzma") compresses every new page and dictionary
+    if compression is not None and compression not in COMPRESSORS:
+        raise ValueError(f"Unknown compression {compression}")
+    compress = COMPRESSORS[compression][0] if compression else None
+    f.write(HEADER.pack(MAGIC, 0, 0))
+    directory = {"byteorder": sys.byteorder, "tables": {}}
+    for name, table in tables.items():
+        snapshot = snapshots[name] if snapshots else table.snapshot()
+        count, version, lsn = snapshot
+        # deleted rows are left out, so the file only holds live ones
+        positions = table.live(snapshot)
+        if positions is not None:
+            count = len(positions)
+        columns = {}
+        for col in table.columns:
+            if positions is not None:
+                column = Column([table.value(p, col) for p in positions])
+            elif isinstance(table, ColumnTable):
+                column = table.data[col]
+            else:
+                column = Column(table.column_values(col, count))
+            # the offsets of the missing values within each page
+            nulls = {}
+            for position in list(column.nulls):
+                if position < count:
+                    nulls.setdefault(position // PAGE_ROWS, []).append(position % PAGE_ROWS)
+            # the bounds of typed columns are saved, so opening the file never has to read a column for them
+            bounds = table.column_bounds(col)
+            meta = {"kind": column.kind, "pages": [], "dictionary": None,
+                    "bounds": None if bounds is None else list(bounds)}
+            for number, (rows, data, encoding, compressed) in enumerate(column.encoded_pages(count)):
+                if compress and compressed is None:
+                    data, compressed = compress(data), compression
+                meta["pages"].append([f.tell(), len(data), rows, encoding, compressed, None])
+                f.write(data)
+                if number in nulls:
+                    # [offset, length, number of missing values] of the page's bitmap
+                    data = zlib.compress(null_bitmap(nulls[number], rows))
+                    meta["pages"][-1][5] = [f.tell(), len(data), len(nulls[number])]
+                    f.write(data)
+            if column.kind == "str":
+                data = json.dumps(column.dictionary).encode()
+                if compress:
+                    data = compress(data)
+                meta["dictionary"] = [f.tell(), len(data), compression]
+                f.write(data)
+            columns[col] = meta
+        directory["tables"][name] = {
+            "columns": table.columns,
+            "count": count,
+            "data": columns,
+            "indexes": table.index_kinds(),
+            "types": table.types,
+            "lsn": lsn
+        }
+    data = json.dumps(directory).encode()
+    offset = f.tell()
+    f.write(data)
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, offset, len(data)))
+
+
+def read_binary(buffer, cache=None):
+    magic, offset, length = HEADER.unpack_from(buffer)
+    directory = json.loads(buffer[offset:offset + length])
+    swap = directory["byteorder"] != sys.byteorder
+    return {name: MappedTable.open(name, meta, buffer, swap, cache) for name, meta in directory["tables"].items()}
+
+
+# page cache
+## The decoded pages of mapped columns live in one PageCache per database, in least recently
+## used order. Once they take more than budget bytes the oldest pages are dropped: a page still
+## equal to the file is simply decoded again when it is next read, and a page changed by inserts
+## (dirty) is first written back to a temporary spill file. budget=None keeps every page.
+
+def page_size(page):
+    # bytes held by a decoded page; lists are counted as one pointer plus a small object per value
+    if isinstance(page, array.array):
+        return len(page) * page.itemsize
+    return len(page) * 40
+
+
+class PageCache:
+    def __init__(self, budget=None):
+        self.budget = budget
+        # (column id, page number) -> [page, size, dirty, column]
+        self.pages = collections.OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.write_backs = 0
+        self.spill = None
+        self.lock = threading.RLock()
+
+    def get(self, owner, number):
+        key = (id(owner), number)
+        with self.lock:
+            entry = self.pages.get(key)
+            if entry is not None:
+                self.hits += 1
+                self.pages.move_to_end(key)
+                return entry[0]
+            self.misses += 1
+            page = owner.load_page(number)
+            self.put(owner, number, page)
+            return page
+
+    def put(self, owner, number, page, dirty=False):
+        # (re)adds a page, e.g. after it grew; a dirty page stays dirty until it is written back
+        key = (id(owner), number)
+        with self.lock:
+            entry = self.pages.pop(key, None)
+            if entry is not None:
+                self.used -= entry[1]
+                dirty = dirty or entry[2]
+            size = page_size(page)
+            self.pages[key] = [page, size, dirty, owner]
+            self.used += size
+            self.evict()
+
+    def evict(self):
+        while self.budget is not None and self.used > self.budget and self.pages:
+            (_, number), (page, size, dirty, owner) = self.pages.popitem(last=False)
+            self.used -= size
+            self.evictions += 1
+            if dirty:
+                owner.write_back(number, page)
+                self.write_backs += 1
+
+    def discard(self, owner):
+        with self.lock:
+            for key in [key for key in self.pages if key[0] == id(owner)]:
+                self.used -= self.pages.pop(key)[1]
+
+    def write(self, data):
+        # appends data to the spill file and returns its offset
+        with self.lock:
+            if self.spill is None:
+                self.spill = tempfile.TemporaryFile()
+            self.spill.seek(0, os.SEEK_END)
+            offset = self.spill.tell()
+            self.spill.write(data)
+            return offset
+
+    def read(self, offset, length):
+        with self.lock:
+            self.spill.seek(offset)
+            return self.spill.read(length)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "budget": self.budget,
+                "used": self.used,
+                "pages": len(self.pages),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "write_backs": self.write_backs,
+            }
+
+
+class PageNulls:
+    # the missing values of a MappedColumn, behaving like the set of their positions: the bitmap of
+    # a page is only read from the file the first time the page is asked about, and the missing
+    # values added since the file was opened are kept in a set
+    def __init__(self, buffer, pages, added=()):
+        self.buffer = buffer
+        # [offset, length, count] of each page's bitmap, or None for a page without missing values
+        self.pages = pages
+        self.in_file = any(page is not None for page in pages)
+        self.bitmaps = {}
+        self.added = set(added)
+
+    def bitmap(self, number):
+        bitmap = self.bitmaps.get(number)
+        if bitmap is None:
+            offset, length, count = self.pages[number]
+            bitmap = self.bitmaps[number] = zlib.decompress(self.buffer[offset:offset + length])
+        return bitmap
+
+    def __contains__(self, position):
+        if position in self.added:
+            return True
+        number, offset = divmod(position, PAGE_ROWS)
+        if number >= len(self.pages) or self.pages[number] is None:
+            return False
+        bitmap = self.bitmap(number)
+        # rows added to the page after it was saved are past the end of its bitmap
+        return offset >> 3 < len(bitmap) and bitmap[offset >> 3] >> (offset & 7) & 1 == 1
+
+    def __iter__(self):
+        for number, page in enumerate(self.pages):
+            if page is not None:
+                yield from bitmap_positions(self.bitmap(number), number * PAGE_ROWS)
+        yield from list(self.added)
+
+    def __len__(self):
+        return sum(page[2] for page in self.pages if page is not None) + len(self.added)
+
+    def __bool__(self):
+        # asked on every read, so without going through the pages
+        return self.in_file or bool(self.added)
+
+    def add(self, position):
+        self.added.add(position)
+
+    def update(self, positions):
+        self.added.update(positions)
+
+
+class MappedColumn(Column):
+    # a column whose pages stay in the mapped file until they are read, and then in the page cache.
+    # Inserts fill the last page and add new ones in the cache; only widening the column to
+    # another kind turns it into an ordinary in-memory column
+    def __init__(self, buffer, meta, count, swap=False, cache=None):
+        super().__init__()
+        self.buffer = buffer
+        self.kind = meta["kind"]
+        # files written before the pages had bitmaps list every missing value in the directory
+        self.nulls = PageNulls(buffer, [page[5] if len(page) > 5 else None for page in meta["pages"]],
+                               meta.get("nulls", ()))
+        # where each page is stored: [source, offset, length, rows, encoding, compression] with
+        # source "file" or "spill", or None while a changed page is only in the cache
+        self.locations = [["file", *page[:3], *(page[3:5] or ["plain", None])] for page in meta["pages"]]
+        self.dictionary_at = meta["dictionary"]
+        self.count = count
+        self.swap = swap
+        self.cache = cache or PageCache()
+        self.values = None
+        # the page read last, so a scan only goes through the cache when it moves to another page.
+        # Pages only grow, so a page object dropped by the cache still holds correct values
+        self.recent = (None, None)
+
+    def __len__(self):
+        return self.count if self.values is None else len(self.values)
+
+    def load_dictionary(self):
+        if self.kind == "str" and self.dictionary is None:
+            offset, length, compression = (*self.dictionary_at, None)[:3]
+            data = self.buffer[offset:offset + length]
+            self.dictionary = json.loads(COMPRESSORS[compression][1](data) if compression else data)
+
+    def stored(self, number):
+        # the bytes of a page as written, uncompressed
+        source, offset, length, rows, encoding, compression = self.locations[number]
+        data = self.buffer[offset:offset + length] if source == "file" else self.cache.read(offset, length)
+        return COMPRESSORS[compression][1](data) if compression else data
+
+    def load_page(self, number):
+        # called by the cache on a miss
+        data = self.stored(number)
+        source, encoding = self.locations[number][0], self.locations[number][4]
+        if self.kind in (None, "object"):
+            return json.loads(data)
+        return decode_page(data, self.kind, encoding, self.swap and source == "file")
+
+    def write_back(self, number, page):
+        # called by the cache before it drops a dirty page
+        data = json.dumps(page).encode() if self.kind in (None, "object") else page.tobytes()
+        encoding = "json" if self.kind in (None, "object") else "plain"
+        self.locations[number] = ["spill", self.cache.write(data), len(data), len(page), encoding, None]
+
+    def page(self, number):
+        self.load_dictionary()
+        return self.cache.get(self, number)
+
+    def get(self, position):
+        if self.values is not None:
+            return super().get(position)
+        if self.nulls and position in self.nulls:
+            return None
+        number, offset = divmod(position, PAGE_ROWS)
+        recent, page = self.recent
+        if recent != number or offset >= len(page):
+            page = self.page(number)
+            self.recent = (number, page)
+        value = page[offset]
+        return self.dictionary[value] if self.kind == "str" else value
+
+    def to_list(self, count=None):
+        if self.values is not None:
+            return super().to_list(count)
+        count = self.count if count is None else count
+        result = []
+        for number in range((count + PAGE_ROWS - 1) // PAGE_ROWS):
+            page = self.page(number)
+            result.extend([self.dictionary[code] for code in page] if self.kind == "str" else page)
+        del result[count:]
+        for position in list(self.nulls):
+            if position < count:
+                result[position] = None
+        return result
+
+    def stored_pages(self, count):
+        if self.values is not None:
+            yield from super().stored_pages(count)
+            return
+        self.load_dictionary()
+        for number in range((count + PAGE_ROWS - 1) // PAGE_ROWS):
+            start = number * PAGE_ROWS
+            rows = min(PAGE_ROWS, count - start)
+            location = self.locations[number]
+            # an rle page read straight from the file is filtered run by run
+            if location and location[4] == "rle" and location[3] == rows and (id(self), number) not in self.cache.pages:
+                yield start, decode_runs(self.stored(number), self.kind, self.swap and location[0] == "file")
+            else:
+                yield start, self.page(number)[:rows]
+
+    def array(self, count=None):
+        if self.values is not None:
+            return super().array(count)
+        count = self.count if count is None else count
+        result = array.array(TYPECODES[self.kind])
+        for number in range((count + PAGE_ROWS - 1) // PAGE_ROWS):
+            result.extend(self.page(number))
+        del result[count:]
+        return result
+
+    def materialize(self):
+        if self.values is not None:
+            return
+        values = array.array(TYPECODES[self.kind]) if self.kind in TYPECODES else []
+        for number in range(len(self.locations)):
+            values.extend(self.page(number))
+        if self.kind == "str":
+            self.codes = {value: code for code, value in enumerate(self.dictionary)}
+        self.values = values
+        self.cache.discard(self)
+
+    def widened(self, value):
+        self.materialize()
+        return super().widened(value)
+
+    def append(self, value):
+        return self.extend([value]) == 1
+
+    def extend(self, values):
+        if self.values is not None:
+            return super().extend(values)
+        # the values are converted by a scratch column sharing this column's dictionary,
+        # then copied into the last page and new ones, which stay dirty in the cache
+        self.load_dictionary()
+        if self.kind == "str" and self.codes is None:
+            self.codes = {value: code for code, value in enumerate(self.dictionary)}
+        scratch = Column()
+        scratch.kind, scratch.dictionary, scratch.codes = self.kind, self.dictionary, self.codes
+        scratch.values = array.array(TYPECODES[self.kind]) if self.kind in TYPECODES else []
+        done = scratch.extend(values)
+        start = self.count
+        written = 0
+        with self.cache.lock:
+            while written < done:
+                number = (start + written) // PAGE_ROWS
+                if number == len(self.locations):
+                    self.locations.append(None)
+                    page = array.array(TYPECODES[self.kind]) if self.kind in TYPECODES else []
+                else:
+                    page = self.page(number)
+                    self.locations[number] = None
+                room = PAGE_ROWS - len(page)
+                page.extend(scratch.values[written:written + room])
+                written += min(room, done - written)
+                self.cache.put(self, number, page, dirty=True)
+        self.nulls.update(start + position for position in scratch.nulls)
+        self.count = start + done
+        return done
+
+    def encoded_pages(self, count=None):
+        if self.values is not None or self.swap:
+            self.materialize()
+            yield from super().encoded_pages(count)
+            return
+        count = self.count if count is None else count
+        self.load_dictionary()
+        for number in range((count + PAGE_ROWS - 1) // PAGE_ROWS):
+            rows = min(PAGE_ROWS, count - number * PAGE_ROWS)
+            location = self.locations[number]
+            if location and location[0] == "file" and location[3] == rows:
+                # untouched pages are copied straight from the mapped file, still encoded and compressed
+                yield rows, self.buffer[location[1]:location[1] + location[2]], location[4], location[5]
+                continue
+            page = self.page(number)[:rows]
+            if self.kind in TYPECODES:
+                encoding, data = encode_page(page, self.kind)
+                yield rows, data, encoding, None
+            else:
+                yield rows, json.dumps(page).encode(), "json", None
+
+
+class MappedTable(ColumnTable):
+    # a columnar table opened from a binary file; indexes are only built once they are needed
+    @classmethod
+    def open(cls, name, meta, buffer, swap=False, cache=None):
+        table = cls(name)
+        table.columns = meta["columns"]
+        table.count = meta["count"]
+        table.data = {col: MappedColumn(buffer, meta["data"][col], table.count, swap, cache)
+                      for col in table.columns}
+        table.pending_indexes = dict(meta["indexes"])
+        table.types = meta.get("types", {})
+        table.bounds = {col: tuple(meta["data"][col]["bounds"]) for col in table.columns
+                        if meta["data"][col].get("bounds") is not None}
+        table.lsn = meta["lsn"]
+        return table
+
+    def column_bounds(self, column):
+        # only the bounds saved in the file (and widened by inserts since): working them out would
+        # read the whole column, so a column saved without them counts as untyped here
+        return self.bounds.get(column) if column in self.types else None
+
+    def build_indexes(self, columns=None):
+        for column in list(columns or self.pending_indexes):
+            if column in self.pending_indexes:
+                self.create_index(column, self.pending_indexes.pop(column))
+
+    def create_index(self, column, kind="hash"):
+        # an index asked for now replaces the one saved for the column, which must not be built later
+        if column in self.columns and kind in INDEX_KINDS:
+            self.pending_indexes.pop(column, None)
+        super().create_index(column, kind)
+
+    def insert(self, values):
+        self.build_indexes()
+        super().insert(values)
+
+    def store(self, batch):
+        self.build_indexes()
+        return super().store(batch)
+
+    def plan(self, where, scan=True, lazy=False, wanted=None):
+        # only the indexes this query could use are built, and none when the saved bounds
+        # already rule the query out (building an index reads the whole column)
+        if where and all(self.selectivity(column, *parse_condition(condition))
+                         for column, condition in where.items() if column in self.columns):
+            self.build_indexes(where)
+        return super().plan(where, scan, lazy, wanted)
+
+    def index_kinds(self):
+        # indexes not built yet are saved too, without building them
+        kinds = dict(self.pending_indexes)
+        kinds.update(super().index_kinds())
+        return kinds
+
+    def vacuum(self):
+        self.build_indexes()
+        return super().vacuum()
+# query
+## db.query("employees").join("departments", on=("dept_id", "id")).where({"salary": (">", 1000)})
+##   .select("name", "departments.title")
+## Columns may be written "table.column", or just "column" when only one table has it.
+## Every where condition names a single table, so it is applied to that table before joining.
+## Each join is run as a hash join, or as an index nested loop join when the new table has an
+## index on its join column and fewer rows are expected on the left than on the right.
+
+class Query:
+    def __init__(self, db, table_name):
+        self.db = db
+        self.tables = [db.get_table(table_name)]
+        # (right table, left table, left column, right column) per join, in the order given
+        self.joins = []
+        self.conditions = {table_name: {}}
+
+    def join(self, table_name, on):
+        table = self.db.get_table(table_name)
+        if table_name in self.conditions:
+            raise ValueError(f"Table {table_name} is already part of the query")
+        left, right = (on, on) if isinstance(on, str) else on
+        left_table, left_column = self.resolve(left)
+        if right not in table.columns:
+            raise ValueError(f"Column {right} does not exist in {table_name}")
+        self.tables.append(table)
+        self.joins.append((table, left_table, left_column, right))
+        self.conditions[table_name] = {}
+        return self
+
+    def where(self, where):
+        for name, condition in where.items():
+            table, column = self.resolve(name)
+            self.conditions[table.name][column] = condition
+        return self
+
+    def resolve(self, name):
+        if "." in name:
+            table_name, column = name.split(".", 1)
+            for table in self.tables:
+                if table.name == table_name and column in table.columns:
+                    return table, column
+            raise ValueError(f"Column {name} does not exist")
+        found = [table for table in self.tables if name in table.columns]
+        if not found:
+            raise ValueError(f"Column {name} does not exist")
+        if len(found) > 1:
+            raise ValueError(f"Column {name} is ambiguous, write it as table.column")
+        return found[0], name
+
+    def plan(self):
+        base = self.tables[0]
+        rows = base.estimate(self.conditions[base.name])
+        steps = [("scan", base, rows)]
+        for table, left_table, left_column, right_column in self.joins:
+            right_rows = table.estimate(self.conditions[table.name])
+            index = table.indexes.get(right_column)
+            if index and index.supports("==") and rows < right_rows:
+                steps.append(("index", table, left_table, left_column, right_column, rows))
+            else:
+                build = "right" if right_rows <= rows else "left"
+                steps.append(("hash", table, left_table, left_column, right_column, build))
+            # most joins follow a foreign key, where each row on the left finds one partner,
+            # so the estimate for the left input carries over to the next join
+        return steps
+
+    def explain(self):
+        lines = []
+        for step in self.plan():
+            if step[0] == "scan":
+                _, table, rows = step
+                lines.append(f"scan {table.name}{self.describe(table)} (~{rows} rows)")
+                continue
+            kind, table, left_table, left_column, right_column, detail = step
+            on = f"{left_table.name}.{left_column} = {table.name}.{right_column}"
+            if kind == "index":
+                lines.append(f"index nested loop join {table.name} on {on} "
+                             f"using {table.indexes[right_column].kind} index ({detail} probes)"
+                             f"{self.describe(table)}")
+            else:
+                side = table.name if detail == "right" else "left input"
+                lines.append(f"hash join {table.name} on {on} building on {side}{self.describe(table)}")
+        return "\n".join(lines)
+
+    def describe(self, table):
+        where = self.conditions[table.name]
+        return f" where {where}" if where else ""
+
+    def run(self):
+        # returns one tuple of row positions per result row, in the order of self.tables
+        slots = {}
+        results = []
+        for step in self.plan():
+            table = step[1]
+            where = self.conditions[table.name]
+            if step[0] == "scan":
+                results = [(position,) for position in table.find(where)]
+                slots[table.name] = 0
+                continue
+            kind, table, left_table, left_column, right_column, detail = step
+            left_slot = slots[left_table.name]
+            joined = []
+            if kind == "index":
+                index = table.indexes[right_column]
+                test = table.compile([(column, *parse_condition(condition)) for column, condition in where.items()])
+                for result in results:
+                    value = left_table.value(result[left_slot], left_column)
+                    if value is None:
+                        continue
+                    for position in table.visible(index.lookup("==", value, table.count)):
+                        if test(position):
+                            joined.append(result + (position,))
+            elif detail == "right":
+                buckets = {}
+                for position in table.find(where):
+                    value = table.value(position, right_column)
+                    if value is not None:
+                        buckets.setdefault(value, []).append(position)
+                for result in results:
+                    for position in buckets.get(left_table.value(result[left_slot], left_column), ()):
+                        joined.append(result + (position,))
+            else:
+                buckets = {}
+                for result in results:
+                    value = left_table.value(result[left_slot], left_column)
+                    if value is not None:
+                        buckets.setdefault(value, []).append(result)
+                for position in table.find(where):
+                    for result in buckets.get(table.value(position, right_column), ()):
+                        joined.append(result + (position,))
+            results = joined
+            slots[table.name] = len(slots)
+        return results
+
+    def select(self, *columns):
+        if not columns:
+            columns = [f"{table.name}.{column}" for table in self.tables for column in table.columns]
+        slots = {table.name: slot for slot, table in enumerate(self.tables)}
+        resolved = [(name, *self.resolve(name)) for name in columns]
+        return [{name: table.value(result[slots[table.name]], column) for name, table, column in resolved}
+                for result in self.run()]
+
+
+# bulk loading
+## CSV has no types, so a column the table gives a type (types={"num": "str"}) is converted to
+## it field by field, and any other column keeps its fields as strings: guessing a type from the
+## values would turn "001" into 1, and could make a column ints in one batch and strings in the
+## next. Empty fields become None (or "" in a column of type "str").
+
+# how a field of a typed column is read; bools as csv.writer writes them, or as 1 and 0
+CSV_BOOLS = {"True": True, "False": False, "true": True, "false": False, "1": True, "0": False}
+CSV_CONVERTERS = {"int": int, "float": float, "bool": CSV_BOOLS.__getitem__}
+
+
+def read_csv(f, columns, batch_size=10000, types=None):
+    # yields lists of up to batch_size rows; types maps columns to their declared types
+    types = types or {}
+    reader = csv.reader(f)
+    header = next(reader, None)
+    if header is None:
+        return
+    unknown = [name for name in header if name not in columns]
+    if unknown:
+        raise ValueError(f"Columns {unknown} do not exist")
+    order = [header.index(col) if col in header else None for col in columns]
+    while True:
+        batch = list(itertools.islice(reader, batch_size))
+        if not batch:
+            return
+        if set(map(len, batch)) != {len(header)}:
+            raise ValueError("The number of values does not match the number of columns")
+        converted = [[None] * len(batch) if number is None
+                     else convert_typed_csv_column([fields[number] for fields in batch], col, types[col])
+                     if col in types else convert_csv_column([fields[number] for fields in batch])
+                     for col, number in zip(columns, order)]
+        yield list(zip(*converted))
+
+
+def convert_csv_column(fields):
+    # the fields of an untyped column, as strings
+    if "" in fields:
+        return [None if field == "" else field for field in fields]
+    return fields
+
+
+def convert_typed_csv_column(fields, column, kind):
+    name = kind.rstrip("?")
+    if name == "str":
+        return [None if field == "" else field for field in fields] if kind.endswith("?") else fields
+    convert = CSV_CONVERTERS[name]
+    if "" not in fields:
+        try:
+            return list(map(convert, fields))
+        except (ValueError, KeyError):
+            pass
+    values = []
+    for field in fields:
+        if field == "":
+            values.append(None)
+            continue
+        try:
+            values.append(convert(field))
+        except (ValueError, KeyError):
+            raise ValueError(f"Column {column} expects {kind}, got {field!r}") from None
+    return values
+
+
+def read_jsonl(f, columns, batch_size=10000):
+    # yields lists of up to batch_size rows
+    lines = (line for line in f if line.strip())
+    while True:
+        batch = [json.loads(line) for line in itertools.islice(lines, batch_size)]
+        if not batch:
+            return
+        yield [[values.get(col, None) for col in columns] if isinstance(values, dict) else values
+               for values in batch]
+
+
+# result cache
+## SimpleDB(result_cache_size=...) keeps the rows of recent select_from calls, keyed on the table,
+## columns, where clause, limit and offset. Each entry remembers the table object and its
+## published (count, version, dead) at the time of the query; any insert, update or delete
+## changes that tuple and vacuum() replaces the table, so a stale entry is never returned.
+## The cache holds at most size values (rows times columns), dropping the least recently used
+## entries first. The cached rows are never handed out: select_from returns copies of them on a
+## hit and on the miss that filled the entry, so a caller changing its rows can't change later hits.
+
+class ResultCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(table_name, columns, where, limit, offset, order_by=None):
+        return (table_name, columns, repr(sorted(where.items())) if where else None, limit, offset,
+                repr(order_by) if order_by else None)
+
+    def get(self, key, table):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is table and entry[1] == table.published:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[2]
+            if entry is not None:
+                self.invalidations += 1
+                self.used -= self.entries.pop(key)[3]
+            self.misses += 1
+            return None
+
+    def put(self, key, table, published, rows):
+        size = len(rows) * max(1, len(key[1]))
+        if size > self.size:
+            return
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.used -= entry[3]
+            self.entries[key] = (table, published, rows, size)
+            self.used += size
+            while self.used > self.size:
+                self.used -= self.entries.popitem(last=False)[1][3]
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": self.size,
+                "used": self.used,
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
+
+
+# instrumentation
+## db.start_profiling(slow_query_ms=50, slow_query_log="slow.jsonl") (or SimpleDB(..., profile=True,
+## slow_query_ms=50)) wraps the public operations of one database so every call produces a record:
+##   {"op": "select_from", "table": "employees", "where": {...}, "ms": 12.3, "rows_scanned": 100000,
+##    "rows_returned": 10, "indexes": ["employees.id"], "page_hits": 4, "page_misses": 1, ...}
+## The records are added up per operation for db.stats(), passed to every function in
+## db.profiler.hooks, and kept (and appended to the slow query log) when they took slow_query_ms or
+## more. Tables add their part (rows scanned, indexes used, bytes written) to the record of the
+## operation running in the same thread through note().
+## Without start_profiling the operations are the plain methods, and note() costs one attribute
+## lookup per query, so a database that is not profiled runs as fast as before.
+
+PROFILED = ("create_index", "insert_into", "insert_many", "bulk_load", "update", "delete_from", "vacuum",
+            "select_from", "aggregate_from", "save", "checkpoint")
+
+# what stats() adds up over every record
+COUNTERS = ("rows_scanned", "rows_returned", "rows_written", "full_scans", "bytes_written",
+            "result_cache_hits", "result_cache_misses")
+
+# the record of the operation running in each thread; a class attribute so that threads
+# with no operation find None without an AttributeError being raised and caught
+class Operation(threading.local):
+    record = None
+
+
+OPERATION = Operation()
+
+
+def note(key, amount=1):
+    record = OPERATION.record
+    if record is not None:
+        record[key] = record.get(key, 0) + amount
+
+
+def note_index(table_name, column):
+    record = OPERATION.record
+    if record is not None:
+        record.setdefault("indexes", []).append(f"{table_name}.{column}")
+
+
+class Profiler:
+    def __init__(self, slow_ms=None, slow_log=None, cache=None, keep=100):
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.cache = cache
+        # the slowest calls are kept newest last, at most keep of them
+        self.slow = collections.deque(maxlen=keep)
+        # operation -> [calls, errors, total seconds, max seconds, recent durations]
+        self.operations = {}
+        self.counters = collections.Counter()
+        self.index_uses = collections.Counter()
+        # functions called with every finished record
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def run(self, operation, method, *args, **kwargs):
+        record = {"op": operation}
+        if args and isinstance(args[0], str):
+            record["table"] = args[0]
+        where = kwargs.get("where", args[1] if operation in ("update", "delete_from") and len(args) > 1 else None)
+        if where:
+            record["where"] = where
+        outer = OPERATION.record
+        OPERATION.record = record
+        cache = self.cache
+        hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+        started = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+            # selects return rows; inserts, updates and deletes the number of rows they changed
+            if isinstance(result, list):
+                record["rows_returned"] = len(result)
+            elif operation == "insert_into":
+                record["rows_written"] = 1
+            elif type(result) is int:
+                record["rows_written"] = result
+            return result
+        except Exception as error:
+            record["error"] = repr(error)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            OPERATION.record = outer
+            record["ms"] = elapsed * 1000
+            # page cache use is read from its counters, so other threads' reads may be included
+            if cache is not None and cache.hits + cache.misses != hits + misses:
+                record["page_hits"] = cache.hits - hits
+                record["page_misses"] = cache.misses - misses
+            self.finish(record, elapsed)
+
+    def finish(self, record, elapsed):
+        with self.lock:
+            entry = self.operations.get(record["op"])
+            if entry is None:
+                entry = self.operations[record["op"]] = [0, 0, 0.0, 0.0, collections.deque(maxlen=1000)]
+            entry[0] += 1
+            entry[1] += "error" in record
+            entry[2] += elapsed
+            entry[3] = max(entry[3], elapsed)
+            entry[4].append(elapsed)
+            for key in COUNTERS:
+                if key in record:
+                    self.counters[key] += record[key]
+            self.index_uses.update(record.get("indexes", ()))
+            slow = self.slow_ms is not None and record["ms"] >= self.slow_ms
+            if slow:
+                self.slow.append(record)
+                if self.slow_log:
+                    with open(self.slow_log, 'a') as f:
+                        f.write(json.dumps(record, default=repr) + "\n")
+        for hook in self.hooks:
+            hook(record)
+
+    def stats(self):
+        with self.lock:
+            operations = {}
+            for name, (calls, errors, total, longest, recent) in self.operations.items():
+                recent = sorted(recent)
+                operations[name] = {
+                    "calls": calls,
+                    "errors": errors,
+                    "total_ms": total * 1000,
+                    "avg_ms": total / calls * 1000,
+                    "max_ms": longest * 1000,
+                    # over the last 1000 calls
+                    "p50_ms": recent[len(recent) // 2] * 1000,
+                    "p99_ms": recent[min(len(recent) - 1, int(len(recent) * 0.99))] * 1000,
+                }
+            return {
+                "operations": operations,
+                **{key: self.counters[key] for key in COUNTERS},
+                "index_uses": dict(self.index_uses),
+                "slow_query_ms": self.slow_ms,
+                "slow_queries": list(self.slow),
+            }
+
+
+def sync_directory(filename):
+    # makes a rename in the file's directory durable; not possible on Windows, where it isn't needed
+    try:
+        fd = os.open(os.path.dirname(filename) or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# cursor
+## Wraps the rows of an iter_select so they can be fetched one at a time or in batches.
+
+class Cursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchmany(self, size=100):
+        return list(itertools.islice(self.rows, size))
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        self.rows.close()
+
+
 # database clas
 ## A class to manage multiple tables and handle file storage.
 
 class SimpleDB:
-    def __init__(self, filename):
+    def __init__(self, filename, wal=False, sync=True, binary=False, cache_size=None, result_cache_size=None,
+                 segments=False, compression=None, profile=False, slow_query_ms=None, slow_query_log=None):
         self.filename = filename
         self.tables = {}
+        # binary=True saves in the paged binary format; an existing binary file is detected on load
+        self.binary = binary
+        self.mapped = None
+        # "zlib" or "lzma" compresses the pages of binary saves
+        if compression is not None and compression not in COMPRESSORS:
+            raise ValueError(f"Unknown compression {compression}")
+        self.compression = compression
+        # pages of a binary file are decoded into this cache; cache_size bounds it in bytes
+        self.cache = PageCache(cache_size)
+        # opt-in cache of select_from results, holding at most result_cache_size values
+        self.results = ResultCache(result_cache_size) if result_cache_size else None
+        # segments=True saves each table in its own file and only rewrites the tables that changed;
+        # filename then holds a manifest naming the segment files
+        self.segments = segments
+        self.manifest = {"format": "segments", "generation": 0, "tables": {}}
+        # what each table looked like when its segment was written
+        self.saved = {}
+        self.segment_maps = []
+        # write-ahead log: every change is appended to filename.wal and folded
+        # into the snapshot file only when checkpoint() is called
+        self.wal = wal
+        self.sync = sync
+        self.wal_filename = filename + '.wal'
+        self.wal_file = None
+        self.lsn = 0
+        # guards the table list and the log; each table has its own lock for its rows
+        self.lock = threading.RLock()
+        self.vacuum_thread = None
+        self.vacuum_stop = threading.Event()
+        # set by start_profiling(); slow_query_ms alone also turns profiling on
+        self.profiler = None
+        if profile or slow_query_ms is not None:
+            self.start_profiling(slow_query_ms, slow_query_log)
         self.load()
 
-    def create_table(self, name, columns):
-        if name in self.tables:
-            raise ValueError(f"Table {name} already exists")
-        table = Table(name)
-        table.set_columns(columns)
-        self.tables[name] = table
+    def create_table(self, name, columns, storage="rows", types=None):
+        if storage not in STORAGE_KINDS:
+            raise ValueError(f"Unknown storage {storage}")
+        with self.lock:
+            if name in self.tables:
+                raise ValueError(f"Table {name} already exists")
+            table = STORAGE_KINDS[storage](name)
+            table.set_columns(columns)
+            table.set_types(types or {})
+            self.tables[name] = table
+            self.log({"op": "create_table", "table": name, "columns": columns, "storage": storage,
+                      "types": table.types})
 
-    def insert_into(self, table_name, values):
+    def get_table(self, table_name):
         table = self.tables.get(table_name)
-        if not table:
+        if table is None:
             raise ValueError(f"Table {table_name} does not exist")
-        table.insert(values)
+        return table
 
-    def select_from(self, table_name, *columns):
-        table = self.tables.get(table_name)
-        if not table:
-            raise ValueError(f"Table {table_name} does not exist")
-        return table.select(*columns)
+    @contextlib.contextmanager
+    def writing(self, table_name):
+        # holds the lock of the current table; if vacuum() replaced the table while we waited, try its copy
+        while True:
+            table = self.get_table(table_name)
+            with table.lock:
+                if not table.retired:
+                    yield table
+                    return
+
+    def create_index(self, table_name, column, kind="hash"):
+        # the change and its log record happen under the table lock, so the log keeps each table's order
+        with self.writing(table_name) as table:
+            table.create_index(column, kind)
+            self.log({"op": "create_index", "table": table_name, "column": column, "kind": kind})
+
+    def insert_into(self, table_name, values):
+        with self.writing(table_name) as table:
+            table.insert(values)
+            self.log({"op": "insert", "table": table_name, "values": values})
+
+    def update(self, table_name, where, set):
+        # where conditions are logged as [column, op, value] so they survive JSON
+        with self.writing(table_name) as table:
+            updated = table.update(where, set)
+            self.log({"op": "update", "table": table_name, "set": set,
+                      "where": [[column, *parse_condition(condition)] for column, condition in (where or {}).items()]})
+        return updated
+
+    def delete_from(self, table_name, where=None):
+        with self.writing(table_name) as table:
+            deleted = table.delete(where)
+            self.log({"op": "delete", "table": table_name,
+                      "where": [[column, *parse_condition(condition)] for column, condition in (where or {}).items()]})
+        return deleted
+
+    def vacuum(self, table_name=None, min_dead=0.0):
+        # copies every table (or one) whose deleted fraction is above min_dead without its
+        # deleted rows; readers already running keep the old table, writers move on to the copy.
+        # In WAL mode the log holds the deletes, so the file is rewritten by the next checkpoint()
+        vacuumed = []
+        for name in [table_name] if table_name else list(self.tables):
+            with self.writing(name) as table:
+                count, version, dead = table.published
+                if dead and dead / count > min_dead:
+                    self.tables[name] = table.vacuum()
+                    vacuumed.append(name)
+        if vacuumed and not self.wal:
+            self.save()
+        return vacuumed
+
+    def start_vacuum(self, interval=60.0, min_dead=0.2):
+        # vacuums in a background thread every interval seconds
+        def run():
+            while not self.vacuum_stop.wait(interval):
+                self.vacuum(min_dead=min_dead)
+        self.vacuum_stop.clear()
+        self.vacuum_thread = threading.Thread(target=run, daemon=True)
+        self.vacuum_thread.start()
+
+    def stop_vacuum(self):
+        if self.vacuum_thread:
+            self.vacuum_stop.set()
+            self.vacuum_thread.join()
+            self.vacuum_thread = None
+
+    def start_profiling(self, slow_query_ms=None, slow_query_log=None):
+        # the profiled operations become instance attributes wrapping the methods, so stop_profiling()
+        # only has to delete them to get the plain methods back
+        self.stop_profiling()
+        self.profiler = Profiler(slow_query_ms, slow_query_log, self.cache)
+        for name in PROFILED:
+            setattr(self, name, functools.partial(self.profiler.run, name, getattr(type(self), name).__get__(self)))
+        return self.profiler
+
+    def stop_profiling(self):
+        if self.profiler is not None:
+            for name in PROFILED:
+                delattr(self, name)
+            self.profiler = None
+
+    def stats(self):
+        # counters of the caches and tables, plus per operation timings while profiling
+        return {
+            "profile": self.profiler.stats() if self.profiler is not None else None,
+            "page_cache": self.cache.stats(),
+            "result_cache": self.results.stats() if self.results is not None else None,
+            "tables": {name: {"rows": len(table), "deleted": table.published[2], "storage": table.storage,
+                              "indexes": table.index_kinds()} for name, table in list(self.tables.items())},
+        }
+
+    def insert_many(self, table_name, rows, batch_size=10000):
+        rows = iter(rows)
+        return self.insert_batches(table_name, iter(lambda: list(itertools.islice(rows, batch_size)), []))
+
+    def insert_batches(self, table_name, batches):
+        # one log record per batch instead of one per row
+        total = 0
+        # a bulk load only creates objects that stay alive, so the cyclic garbage
+        # collector would just rescan them over and over
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            for batch in batches:
+                with self.writing(table_name) as table:
+                    table.insert_many(batch, len(batch))
+                    self.log({"op": "insert_many", "table": table_name, "rows": batch})
+                total += len(batch)
+        finally:
+            if collecting:
+                gc.enable()
+        return total
+
+    def bulk_load(self, table_name, filename, batch_size=10000):
+        # loads a .csv file (with a header naming the columns) or a .jsonl file
+        # (one list of values or one object per line) into an existing table
+        table = self.get_table(table_name)
+        with open(filename, newline='') as f:
+            if filename.endswith('.csv'):
+                batches = read_csv(f, table.columns, batch_size, table.types)
+            else:
+                batches = read_jsonl(f, table.columns, batch_size)
+            return self.insert_batches(table_name, batches)
+
+    def select_from(self, table_name, *columns, where=None, limit=None, offset=0, order_by=None):
+        table = self.get_table(table_name)
+        if self.results is None:
+            return table.select(*columns, where=where, limit=limit, offset=offset, order_by=order_by)
+        key = ResultCache.key(table_name, columns, where, limit, offset, order_by)
+        rows = self.results.get(key, table)
+        note("result_cache_misses" if rows is None else "result_cache_hits")
+        if rows is None:
+            # the version is read before the query, so rows newer than it only make the entry miss later
+            published = table.published
+            rows = table.select(*columns, where=where, limit=limit, offset=offset, order_by=order_by)
+            self.results.put(key, table, published, rows)
+        return [dict(row) for row in rows]
+
+    def iter_select_from(self, table_name, *columns, where=None, limit=None, offset=0, batch_size=None,
+                         order_by=None):
+        return self.get_table(table_name).iter_select(*columns, where=where, limit=limit, offset=offset,
+                                                      batch_size=batch_size, order_by=order_by)
+
+    def aggregate_from(self, table_name, group_by=(), where=None, **aggregates):
+        return self.get_table(table_name).aggregate(group_by, where=where, **aggregates)
+
+    def query(self, table_name):
+        return Query(self, table_name)
+
+    def cursor(self, table_name, *columns, where=None, limit=None, offset=0, order_by=None):
+        return Cursor(self.iter_select_from(table_name, *columns, where=where, limit=limit, offset=offset,
+                                            order_by=order_by))
+
+    def log(self, record):
+        if not self.wal:
+            return
+        with self.lock:
+            self.lsn += 1
+            record["lsn"] = self.lsn
+            self.tables[record["table"]].lsn = self.lsn
+            line = json.dumps(record) + "\n"
+            note("bytes_written", len(line))
+            self.wal_file.write(line)
+            self.wal_file.flush()
+            if self.sync:
+                os.fsync(self.wal_file.fileno())
+
+    def replay(self, record):
+        table = self.tables.get(record["table"])
+        # records already folded into the snapshot are skipped
+        if table is not None and record["lsn"] <= table.lsn:
+            return
+        if record["op"] == "create_table":
+            table = STORAGE_KINDS[record.get("storage", "rows")](record["table"])
+            table.set_columns(record["columns"])
+            table.set_types(record.get("types", {}))
+            self.tables[table.name] = table
+        elif record["op"] == "create_index":
+            table.create_index(record["column"], record["kind"])
+        elif record["op"] == "insert":
+            table.insert(record["values"])
+        elif record["op"] == "insert_many":
+            table.insert_many(record["rows"])
+        elif record["op"] == "update":
+            table.update({column: (op, value) for column, op, value in record["where"]}, record["set"])
+        elif record["op"] == "delete":
+            table.delete({column: (op, value) for column, op, value in record["where"]})
+        table.lsn = record["lsn"]
 
     def save(self):
-        with open(self.filename, 'w') as f:
-            json.dump({name: table.to_dict() for name, table in self.tables.items()}, f, indent=4)
+        if self.wal:
+            # every change is already in the log, so saving only has to make it durable
+            self.wal_file.flush()
+            with self.lock:
+                self.wal_file.flush()
+                os.fsync(self.wal_file.fileno())
+            return
+        # the file is never overwritten in place, so a crash mid-save leaves the previous one intact
+        self.write_snapshot()
+
+    def snapshot(self):
+        # every table's (row count, version, lsn) taken at the same moment; writers are held up only
+        # while the counts are read, and the rows are serialized afterwards without any lock.
+        # The database lock is not held while waiting for the tables: a writer holding its
+        # table lock may be waiting for it to write its log record
+        with self.lock:
+            tables = dict(self.tables)
+        locked = []
+        try:
+            for name in sorted(tables):
+                tables[name].lock.acquire()
+                locked.append(tables[name])
+            snapshots = {name: table.snapshot() for name, table in tables.items()}
+        finally:
+            for table in locked:
+                table.lock.release()
+        return tables, snapshots
+
+    def write_snapshot(self):
+        # write a new snapshot next to the old one, then swap it in
+        tables, snapshots = self.snapshot()
+        if self.segments:
+            self.write_segments(tables, snapshots)
+            return
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb' if self.binary else 'w') as f:
+            if self.binary:
+                write_binary(f, tables, snapshots, self.compression)
+            else:
+                json.dump({name: table.to_dict(snapshots[name]) for name, table in tables.items()}, f)
+            f.flush()
+            note("bytes_written", f.tell())
+            os.fsync(f.fileno())
+        os.replace(temp_filename, self.filename)
+        sync_directory(self.filename)
+
+    def write_segments(self, tables, snapshots):
+        # every changed table is written to a new segment file named after the next generation,
+        # so the segments of the current manifest are never touched. The new files are all
+        # synced once they are written, then the new manifest replaces the old one, which is
+        # the moment the save takes effect; the segments it no longer names are removed last
+        generation = self.manifest["generation"] + 1
+        directory, base = os.path.split(self.filename)
+        entries = {}
+        written = []
+        # the tables are only recorded as saved once the manifest naming their segments is in place;
+        # a save that fails part way removes the segments it wrote and records nothing
+        saved = {}
+        try:
+            try:
+                for number, name in enumerate(sorted(tables)):
+                    table = tables[name]
+                    state = (table, snapshots[name], table.index_kinds())
+                    if name in self.manifest["tables"] and self.saved.get(name) == state:
+                        entries[name] = self.manifest["tables"][name]
+                        continue
+                    segment = f"{base}.{generation}.{number}"
+                    f = open(os.path.join(directory, segment), 'wb' if self.binary else 'w')
+                    written.append(f)
+                    if self.binary:
+                        write_binary(f, {name: table}, {name: snapshots[name]}, self.compression)
+                    else:
+                        json.dump({name: table.to_dict(snapshots[name])}, f)
+                    f.flush()
+                    note("bytes_written", f.tell())
+                    entries[name] = {"file": segment, "binary": self.binary}
+                    saved[name] = state
+                for f in written:
+                    os.fsync(f.fileno())
+            finally:
+                for f in written:
+                    f.close()
+            if not written and set(entries) == set(self.manifest["tables"]):
+                return
+            manifest = {"format": "segments", "generation": generation, "tables": entries}
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as f:
+                json.dump(manifest, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_filename, self.filename)
+        except BaseException:
+            for f in written:
+                try:
+                    os.remove(f.name)
+                except OSError:
+                    pass
+            raise
+        self.saved.update(saved)
+        sync_directory(self.filename)
+        kept = {entry["file"] for entry in entries.values()}
+        for entry in self.manifest["tables"].values():
+            if entry["file"] not in kept:
+                try:
+                    os.remove(os.path.join(directory, entry["file"]))
+                except OSError:
+                    # still mapped on Windows; it is left behind
+                    pass
+        self.manifest = manifest
+
+    def checkpoint(self):
+        if not self.wal:
+            self.write_snapshot()
+            return
+        # move the log aside so writers can carry on in a new one; everything in the old log is
+        # already applied to the tables, so the snapshot taken next contains it
+        old_filename = self.wal_filename + '.old'
+        with self.lock:
+            self.wal_file.close()
+            if os.path.exists(old_filename):
+                # a previous checkpoint did not finish; keep its records in front of ours
+                with open(old_filename, 'ab') as old, open(self.wal_filename, 'rb') as f:
+                    old.write(f.read())
+                os.remove(self.wal_filename)
+            else:
+                os.replace(self.wal_filename, old_filename)
+            self.wal_file = open(self.wal_filename, 'w')
+        self.write_snapshot()
+        os.remove(old_filename)
+
+    def compact(self):
+        self.checkpoint()
+
+    def close(self):
+        self.stop_vacuum()
+        if self.wal_file:
+            self.wal_file.close()
+            self.wal_file = None
 
     def load(self):
         try:
-            with open(self.filename, 'r') as f:
-                data = json.load(f)
-                for name, table_data in data.items():
-                    table = Table.from_dict(table_data)
-                    self.tables[name] = table
+            with open(self.filename, 'rb') as f:
+                if f.read(len(MAGIC)) == MAGIC:
+                    self.binary = True
+                    self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.tables = read_binary(self.mapped, self.cache)
+                else:
+                    f.seek(0)
+                    data = json.load(f)
+                    if data.get("format") == "segments":
+                        self.load_segments(data)
+                    else:
+                        for name, table_data in data.items():
+                            self.tables[name] = Table.from_dict(table_data, name)
+            for table in self.tables.values():
+                self.lsn = max(self.lsn, table.lsn)
+        except FileNotFoundError:
+            pass
+        if not self.wal:
+            return
+        self.replay_log(self.wal_filename + '.old')
+        valid_size = self.replay_log(self.wal_filename)
+        self.wal_file = open(self.wal_filename, 'a')
+        self.wal_file.truncate(valid_size)
+
+    def load_segments(self, manifest):
+        directory = os.path.dirname(self.filename)
+        self.segments = True
+        self.manifest = manifest
+        for name, entry in manifest["tables"].items():
+            with open(os.path.join(directory, entry["file"]), 'rb') as f:
+                if entry["binary"]:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.segment_maps.append(mapped)
+                    self.tables.update(read_binary(mapped, self.cache))
+                else:
+                    self.tables[name] = Table.from_dict(json.load(f)[name], name)
+            table = self.tables[name]
+            self.saved[name] = (table, table.snapshot(), table.index_kinds())
+            self.binary = self.binary or entry["binary"]
+
+    def replay_log(self, filename):
+        # replays one log file and returns the size of its intact part
+        valid_size = 0
+        try:
+            with open(filename, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a torn record from a crash mid-write; drop it and everything after
+                        break
+                    self.replay(record)
+                    self.lsn = max(self.lsn, record["lsn"])
+                    valid_size += len(line)
         except FileNotFoundError:
             pass
+        return valid_size
 # usage
 def main():
     db = SimpleDB('db.json')
 
-    # Create a table
-    db.create_table('employees', ['id', 'name', 'position'])
+    # Create a table; typed columns reject values of the wrong type
+    db.create_table('employees', ['id', 'name', 'position'],
+                    types={'id': 'int', 'name': 'str', 'position': 'str'})
 
     # Insert data into the table
     db.insert_into('employees', [1, 'Alice', 'Engineer'])
     db.insert_into('employees', [2, 'Bob', 'Manager'])
 
+    # Index the columns we filter on
+    db.create_index('employees', 'id', kind='sorted')
+    db.create_index('employees', 'position')
+
     # Query data from the table
     results = db.select_from('employees', 'name', 'position')
     for row in results:
         print(row)
 
+    # Query only the rows matching a condition
+    print(db.select_from('employees', 'name', where={'position': 'Manager'}))
+    print(db.select_from('employees', 'name', where={'id': ('>=', 1)}))
+
+    # The highest ids first, read straight from the sorted index
+    print(db.select_from('employees', 'name', order_by='-id', limit=1))
+
+    # Change and remove rows; vacuum() drops the deleted ones for good
+    db.update('employees', {'name': 'Bob'}, {'position': 'Director'})
+    db.delete_from('employees', {'id': 1})
+    db.vacuum()
+    print(db.select_from('employees', 'name', 'position'))
+
+    # Time every operation, keeping the ones slower than 10 ms
+    db.start_profiling(slow_query_ms=10)
+    db.select_from('employees', 'name', where={'position': 'Director'})
+    print(db.stats()['profile']['operations'])
+    db.stop_profiling()
+
     # Save the database to a file
     db.save()
 
@@ -0,0 +1,331 @@
+import os
+import json
+import zlib
+import heapq
+import bisect
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from builddb import SimpleDB, parse_condition, parse_aggregates, parse_order, sort_parts
+
+
+# sharded database
+## ShardedDB("sales.json", shards=4) splits every table across the shard files sales.json.0 ...
+## sales.json.3, each an ordinary SimpleDB saved in the binary format, plus sales.json itself
+## which only holds the tables' columns and how they are partitioned.
+## A row goes to one shard by its partition key, either hashed or by range boundaries:
+##   db.create_table("sales", ["id", "day", "amount"], key="id")
+##   db.create_table("log", ["day", "text"], key="day", partition="range", bounds=[100, 200, 300])
+## A where clause fixing the key (==, or a range for range partitions) only visits the shards
+## that can hold it. Other scans and aggregations run on every shard in a pool of processes,
+## each one reading its shard file, and the partial results are merged here. Shards written
+## since the last save() are read in this process instead, so reads never write shard files.
+
+
+def shard_of_value(value, shards):
+    # the same value must land on the same shard in every process, so Python's
+    # randomized str hash can't be used
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, int):
+        return value % shards
+    return zlib.crc32(json.dumps(value).encode()) % shards
+
+
+# worker side
+## Every worker process keeps the shard files it has opened, and opens one again only
+## after the parent saved a new version of it.
+
+OPEN_SHARDS = {}
+
+
+def open_shard(filename):
+    stat = os.stat(filename)
+    stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = OPEN_SHARDS.get(filename)
+    if cached is None or cached[0] != stamp:
+        cached = OPEN_SHARDS[filename] = (stamp, SimpleDB(filename))
+    return cached[1]
+
+
+def scan_shard(db, table_name, columns, where, limit, order_by=None):
+    if isinstance(db, str):
+        db = open_shard(db)
+    return db.select_from(table_name, *columns, where=where, limit=limit, order_by=order_by)
+
+
+def aggregate_shard(db, table_name, group_by, where, requests):
+    if isinstance(db, str):
+        db = open_shard(db)
+    table = db.get_table(table_name)
+    return [table.aggregate(group_by, where=where, **aggregates) for aggregates in requests]
+
+
+def partial_aggregates(aggregates):
+    # what each shard has to compute so the results can be merged: avg becomes sum and count,
+    # and counts of a column go in a second request since count=True takes the same keyword
+    specs = parse_aggregates(aggregates)
+    first, second = {}, {}
+    for name, function, column in specs:
+        if function == "count" and column is None:
+            first["count"] = True
+        elif function == "count":
+            second.setdefault("count", []).append(column)
+        elif function == "avg":
+            first.setdefault("sum", []).append(column)
+            second.setdefault("count", []).append(column)
+        else:
+            first.setdefault(function, []).append(column)
+    return specs, [request for request in (first, second) if request]
+
+
+def merge_aggregates(group_by, specs, partials):
+    # partials holds, for every shard, the rows of each request; rows of the same group are combined
+    groups = {}
+    for shard in partials:
+        for rows in shard:
+            for row in rows:
+                key = tuple(row[col] for col in group_by)
+                merged = groups.setdefault(key, {})
+                for name, value in row.items():
+                    if name in group_by or value is None:
+                        continue
+                    if name not in merged:
+                        merged[name] = value
+                    elif name.startswith("min_"):
+                        merged[name] = min(merged[name], value)
+                    elif name.startswith("max_"):
+                        merged[name] = max(merged[name], value)
+                    else:
+                        merged[name] = merged[name] + value
+    result = []
+    for key, merged in groups.items():
+        row = dict(zip(group_by, key))
+        for name, function, column in specs:
+            if function == "count":
+                row[name] = merged.get(name, 0)
+            elif function == "avg":
+                seen = merged.get(f"count_{column}", 0)
+                row[name] = merged[f"sum_{column}"] / seen if seen else None
+            else:
+                row[name] = merged.get(name)
+        result.append(row)
+    return result
+
+
+class ShardedDB:
+    def __init__(self, filename, shards=4, workers=None):
+        self.filename = filename
+        self.tables = {}
+        self.shard_count = shards
+        self.load()
+        self.shards = [SimpleDB(f"{filename}.{number}", binary=True) for number in range(self.shard_count)]
+        # shards changed since they were last saved; workers only see saved files
+        self.dirty = set()
+        # workers=0 runs every shard in this process, which is cheaper for small tables
+        self.workers = os.cpu_count() if workers is None else workers
+        self.executor = None
+
+    def create_table(self, name, columns, key, partition="hash", bounds=None, storage="columns", types=None):
+        if name in self.tables:
+            raise ValueError(f"Table {name} already exists")
+        if key not in columns:
+            raise ValueError(f"Column {key} does not exist")
+        if partition not in ("hash", "range"):
+            raise ValueError(f"Unknown partition {partition}")
+        if partition == "range" and (bounds is None or len(bounds) != self.shard_count - 1):
+            raise ValueError(f"Range partitions need {self.shard_count - 1} bounds")
+        for shard in self.shards:
+            shard.create_table(name, columns, storage=storage, types=types)
+        self.tables[name] = {"columns": columns, "key": key, "partition": partition,
+                             "bounds": sorted(bounds) if bounds else None, "types": types}
+        self.dirty.update(range(self.shard_count))
+        self.save_meta()
+
+    def get_table(self, table_name):
+        meta = self.tables.get(table_name)
+        if meta is None:
+            raise ValueError(f"Table {table_name} does not exist")
+        return meta
+
+    def create_index(self, table_name, column, kind="hash"):
+        self.get_table(table_name)
+        for shard in self.shards:
+            shard.create_index(table_name, column, kind)
+        self.dirty.update(range(self.shard_count))
+
+    # routing
+
+    def shard_for(self, meta, value):
+        if meta["partition"] == "hash":
+            return shard_of_value(value, self.shard_count)
+        if value is None:
+            return 0
+        return bisect.bisect_right(meta["bounds"], value)
+
+    def shards_for(self, table_name, where):
+        # the shards that may hold rows matching where
+        meta = self.get_table(table_name)
+        if not where or meta["key"] not in where:
+            return list(range(self.shard_count))
+        op, value = parse_condition(where[meta["key"]])
+        if op == "==":
+            return [self.shard_for(meta, value)]
+        if meta["partition"] == "hash" or op == "!=" or value is None:
+            return list(range(self.shard_count))
+        low, high = 0, self.shard_count - 1
+        if op == "between":
+            low, high = self.shard_for(meta, value[0]), self.shard_for(meta, value[1])
+        elif op in ("<", "<="):
+            high = self.shard_for(meta, value)
+        else:
+            low = self.shard_for(meta, value)
+        return list(range(low, high + 1))
+
+    # writes
+
+    def insert_into(self, table_name, values):
+        meta = self.get_table(table_name)
+        number = self.shard_for(meta, values[meta["columns"].index(meta["key"])])
+        self.shards[number].insert_into(table_name, values)
+        self.dirty.add(number)
+
+    def insert_many(self, table_name, rows, batch_size=10000):
+        meta = self.get_table(table_name)
+        key = meta["columns"].index(meta["key"])
+        rows = iter(rows)
+        total = 0
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return total
+            routed = {}
+            for values in batch:
+                routed.setdefault(self.shard_for(meta, values[key]), []).append(values)
+            for number, shard_rows in routed.items():
+                self.shards[number].insert_many(table_name, shard_rows, batch_size)
+                self.dirty.add(number)
+            total += len(batch)
+
+    def update(self, table_name, where, set):
+        if self.get_table(table_name)["key"] in set:
+            raise ValueError("The partition key can not be updated")
+        updated = 0
+        for number in self.shards_for(table_name, where):
+            changed = self.shards[number].update(table_name, where, set)
+            if changed:
+                self.dirty.add(number)
+            updated += changed
+        return updated
+
+    def delete_from(self, table_name, where=None):
+        deleted = 0
+        for number in self.shards_for(table_name, where):
+            changed = self.shards[number].delete_from(table_name, where)
+            if changed:
+                self.dirty.add(number)
+            deleted += changed
+        return deleted
+
+    # reads
+
+    def run(self, function, numbers, *args):
+        # runs function on each shard, in worker processes when there is more than one shard to visit.
+        # Workers read the saved shard files, so a shard changed since the last save runs here
+        # instead, while the workers read the others: a read never saves anything
+        remote = [number for number in numbers if number not in self.dirty]
+        if not self.workers or len(remote) < 2:
+            return [function(self.shards[number], *args) for number in numbers]
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(min(self.workers, self.shard_count))
+        futures = {number: self.executor.submit(function, self.shards[number].filename, *args)
+                   for number in remote}
+        local = {number: function(self.shards[number], *args) for number in numbers if number in self.dirty}
+        return [futures[number].result() if number in futures else local[number] for number in numbers]
+
+    def select_from(self, table_name, *columns, where=None, limit=None, offset=0, order_by=None):
+        # rows come back shard by shard; each shard returns at most offset + limit of them.
+        # With order_by every shard sorts its own rows, and the sorted lists are merged here
+        # (equal rows then come shard by shard)
+        numbers = self.shards_for(table_name, where)
+        wanted = None if limit is None else offset + limit
+        if not order_by:
+            results = self.run(scan_shard, numbers, table_name, columns, where, wanted)
+            rows = list(itertools.chain.from_iterable(results))
+            if offset or limit is not None:
+                rows = rows[offset:wanted]
+            return rows
+        keys = parse_order(order_by, self.get_table(table_name)["columns"])
+        # the order_by columns are fetched too when they were not asked for, and dropped after merging
+        extra = [column for column, _ in keys if column not in columns]
+        results = self.run(scan_shard, numbers, table_name, tuple(columns) + tuple(extra), where, wanted, order_by)
+        parts, reverse = sort_parts(keys)
+        rows = list(itertools.islice(heapq.merge(*results, reverse=reverse, key=lambda row: tuple(
+            part(row[column]) for part, (column, _) in zip(parts, keys))), offset, wanted))
+        for row in rows:
+            for column in extra:
+                del row[column]
+        return rows
+
+    def aggregate_from(self, table_name, group_by=(), where=None, **aggregates):
+        self.get_table(table_name)
+        group_by = list(group_by)
+        specs, requests = partial_aggregates(aggregates)
+        partials = self.run(aggregate_shard, self.shards_for(table_name, where),
+                            table_name, group_by, where, requests)
+        return merge_aggregates(group_by, specs, partials)
+
+    # files
+
+    def save_meta(self):
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump({"shards": self.shard_count, "tables": self.tables}, f, indent=4)
+        os.replace(temp_filename, self.filename)
+
+    def save(self):
+        # only the shards written since the last save are rewritten
+        for number in sorted(self.dirty):
+            self.shards[number].save()
+        self.dirty.clear()
+
+    def checkpoint(self):
+        self.save()
+
+    def close(self):
+        self.save()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        for shard in self.shards:
+            shard.close()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.shard_count = data["shards"]
+        self.tables = data["tables"]
+
+
+# usage
+def main():
+    db = ShardedDB('sales.json', shards=4)
+    if 'sales' not in db.tables:
+        db.create_table('sales', ['id', 'region', 'amount'], key='id',
+                        types={'id': 'int', 'region': 'str', 'amount': 'float'})
+        db.insert_many('sales', [[i, ['north', 'south', 'east'][i % 3], i * 0.5] for i in range(100000)])
+
+    # a point lookup visits one shard
+    print(db.select_from('sales', 'region', 'amount', where={'id': 42}))
+
+    # every shard finds its own top 5, and the lists are merged
+    print(db.select_from('sales', 'id', order_by='-amount', limit=5))
+
+    # an aggregation runs on every shard in parallel and the results are merged
+    print(db.aggregate_from('sales', group_by=['region'], count=True, avg='amount'))
+    db.close()
+
+if __name__ == "__main__":
+    main()
@@ -34,27 +34,111 @@ Manage multiple accounts.
 Methods to add_account, find_account, and transfer_funds between accounts.
 
 """
+import gc
+import os
+import csv
+import json
+import array
+import struct
+import itertools
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # ------------------------------------
 # -------------- OOP -----------------
 # ------------------------------------
+# Money
+# Interest is worked out in integer cents, with the rate as a whole number of billionths and
+# halves rounded to even, so SavingsAccount.apply_interest and Bank.apply_interest_all give
+# exactly the same cents.
+RATE_SCALE = 10 ** 9
+
+
+def to_cents(amount):
+    return round(amount * 100)
+
+
+def rate_units(rate):
+    return round(rate * RATE_SCALE)
+
+
+def interest_cents(cents, units):
+    quotient, remainder = divmod(cents * units, RATE_SCALE)
+    return quotient + (2 * remainder > RATE_SCALE or (2 * remainder == RATE_SCALE and quotient % 2))
+
+
+def interest_cents_array(cents, units):
+    # interest_cents over NumPy arrays; the caller makes sure cents * units fits in 64 bits
+    product = cents * units
+    quotient = product // RATE_SCALE
+    twice = 2 * (product - quotient * RATE_SCALE)
+    return quotient + ((twice > RATE_SCALE) | ((twice == RATE_SCALE) & (quotient % 2 == 1)))
+
+
+# what a checking or savings account gets when none is given
+DEFAULT_TRANSACTION_FEE = 1.00
+DEFAULT_INTEREST_RATE = 0.01
+
+# a fixed set of locks shared by every account (see Account.lock_number); a lock for each
+# account would take more memory than the account itself
+LOCK_STRIPES = [threading.Lock() for _ in range(1024)]
+
+
 class Account:
+    # no per-instance __dict__, and the balance is kept in whole cents; balance reads and sets it in dollars
+    __slots__ = ("account_number", "owner", "cents", "ledger", "ledger_id")
+
     def __init__(self, account_number, owner, initial_balance=0):
         self.account_number = account_number
         self.owner = owner
-        self.balance = initial_balance
+        self.cents = to_cents(initial_balance)
+        # set by Ledger.open_account when the bank keeps a ledger
+        self.ledger = None
+        self.ledger_id = None
+
+    @property
+    def balance(self):
+        return self.cents / 100
+
+    @balance.setter
+    def balance(self, amount):
+        self.cents = to_cents(amount)
+
+    @property
+    def kind(self):
+        # the class of account, which a StoredAccount takes from its row
+        return type(self)
+
+    @property
+    def lock_number(self):
+        # the lock in LOCK_STRIPES held while a TransferEngine changes the balance
+        return hash(self.account_number) % len(LOCK_STRIPES)
+
+    def withdrawal_cost(self, amount):
+        # what withdrawing amount takes from the balance
+        return amount
 
     def deposit(self, amount):
         if amount > 0:
-            self.balance += amount
+            self.cents += to_cents(amount)
+            if self.ledger:
+                self.ledger.record(self, DEPOSIT, amount)
             print(f"Deposited ${amount}. New balance: ${self.balance}.")
         else:
             print("Deposit amount must be positive.")
 
     def withdraw(self, amount):
         if amount > 0:
-            if amount <= self.balance:
-                self.balance -= amount
+            if to_cents(amount) <= self.cents:
+                self.cents -= to_cents(amount)
+                if self.ledger:
+                    self.ledger.record(self, WITHDRAW, -amount)
                 print(f"Withdrew ${amount}. New balance: ${self.balance}.")
             else:
                 print("Insufficient funds.")
@@ -66,41 +150,292 @@ class Account:
 
 
 class CheckingAccount(Account):
-    def __init__(self, account_number, owner, initial_balance=0, transaction_fee=1.00):
+    __slots__ = ("transaction_fee",)
+
+    def __init__(self, account_number, owner, initial_balance=0, transaction_fee=DEFAULT_TRANSACTION_FEE):
         super().__init__(account_number, owner, initial_balance)
         self.transaction_fee = transaction_fee
 
+    def withdrawal_cost(self, amount):
+        return amount + self.transaction_fee
+
     def withdraw(self, amount):
-        total_withdrawal = amount + self.transaction_fee
-        if total_withdrawal <= self.balance:
-            self.balance -= total_withdrawal
+        total_withdrawal = to_cents(amount) + to_cents(self.transaction_fee)
+        if total_withdrawal <= self.cents:
+            self.cents -= total_withdrawal
+            if self.ledger:
+                self.ledger.record(self, WITHDRAW, -amount)
+                self.ledger.record(self, FEE, -self.transaction_fee)
             print(f"Withdrew ${amount} with a transaction fee of ${self.transaction_fee}. New balance: ${self.balance}.")
         else:
             print("Insufficient funds including transaction fee.")
 
 
 class SavingsAccount(Account):
-    def __init__(self, account_number, owner, initial_balance=0, interest_rate=0.01):
+    __slots__ = ("interest_rate",)
+
+    def __init__(self, account_number, owner, initial_balance=0, interest_rate=DEFAULT_INTEREST_RATE):
         super().__init__(account_number, owner, initial_balance)
         self.interest_rate = interest_rate
 
     def apply_interest(self):
-        interest = self.balance * self.interest_rate
-        self.balance += interest
+        earned = interest_cents(self.cents, rate_units(self.interest_rate))
+        interest = earned / 100
+        self.cents += earned
+        if self.ledger:
+            self.ledger.record(self, INTEREST, interest)
         print(f"Applied interest: ${interest}. New balance: ${self.balance}.")
 
 
+ACCOUNT_TYPES = {"Account": Account, "CheckingAccount": CheckingAccount, "SavingsAccount": SavingsAccount}
+
+
+# Bulk files
+# bank.import_accounts("accounts.csv")       adds every account of the file, printing nothing
+# bank.export_accounts("accounts.jsonl")     writes every account of the bank
+# The format follows the extension. A .csv file has a header naming its columns, a .jsonl file
+# holds one JSON object per line, both with the fields of BULK_FIELDS: type is the class name
+# (see ACCOUNT_TYPES), balance is in dollars, and transaction_fee and interest_rate are left
+# empty (or out) for accounts without them, which then get their class's default. The file is
+# read batch_size accounts at a time, so memory use follows the batch and not the file.
+BULK_FIELDS = ("account_number", "owner", "type", "balance", "transaction_fee", "interest_rate")
+
+
+def bulk_format(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in (".csv", ".jsonl"):
+        raise ValueError(f"Unknown bulk file format {extension}, use .csv or .jsonl")
+    return extension[1:]
+
+
+def read_accounts(f, file_format, batch_size):
+    # yields lists of (account_number, owner, type, cents, transaction_fee, interest_rate),
+    # with None for a missing fee or rate
+    if file_format == "csv":
+        reader = csv.reader(f)
+        header = next(reader, [])
+        for name in ("account_number", "owner", "type"):
+            if name not in header:
+                raise ValueError(f"Column {name} does not exist")
+        # columns missing from the header are read from an empty last field
+        positions = [header.index(name) if name in header else len(header) for name in BULK_FIELDS]
+        number, owner, kind, balance, fee, rate = positions
+        while True:
+            rows = list(itertools.islice(reader, batch_size))
+            if not rows:
+                return
+            for row in rows:
+                row.append("")
+            yield [(row[number], row[owner], row[kind], to_cents(float(row[balance] or 0)),
+                    float(row[fee]) if row[fee] else None, float(row[rate]) if row[rate] else None)
+                   for row in rows]
+    else:
+        while True:
+            lines = list(itertools.islice(f, batch_size))
+            if not lines:
+                return
+            # parsed as one JSON list, much faster than line by line
+            rows = json.loads("[" + ",".join(line for line in lines if line.strip()) + "]")
+            yield [(row["account_number"], row["owner"], row["type"], to_cents(row.get("balance") or 0),
+                    row.get("transaction_fee"), row.get("interest_rate")) for row in rows]
+
+
+def account_row(account):
+    # an account as the values of BULK_FIELDS
+    kind = account.kind
+    return (account.account_number, account.owner, kind.__name__, account.balance,
+            account.transaction_fee if kind is CheckingAccount else None,
+            account.interest_rate if kind is SavingsAccount else None)
+
+
 class Bank:
-    def __init__(self):
-        self.accounts = {}
+    def __init__(self, ledger=None, store=None):
+        if ledger is not None and store is not None:
+            raise ValueError("An AccountStore does not keep a ledger")
+        # an AccountStore holds the accounts in columns; otherwise they are objects in a dict
+        self.store = store
+        self.accounts = {} if store is None else store
+        self.ledger = ledger
+        # the savings account objects by account number, in the order they were added, for
+        # apply_interest_all; a dict, so an account that is replaced is dropped in O(1)
+        self.savings = {}
+        # secondary indexes: owner -> account numbers, and account type name -> account numbers,
+        # the numbers kept as the keys of a dict so a replaced account is unlisted in O(1)
+        self.by_owner = defaultdict(dict)
+        self.by_type = defaultdict(dict)
+
+    @classmethod
+    def recover(cls, ledger_filename, snapshot_every=1000000):
+        # the accounts of a ledger with the balances it recorded
+        ledger = Ledger(ledger_filename, snapshot_every)
+        bank = cls(ledger)
+        for description in ledger.descriptions:
+            description = dict(description)
+            account_class = ACCOUNT_TYPES[description.pop("type")]
+            account = account_class(**description)
+            account.cents = ledger.balance(account.account_number)
+            ledger.open_account(account)
+            bank.index_account(account.account_number, account.owner, account.kind.__name__)
+            bank.accounts[account.account_number] = account
+            if isinstance(account, SavingsAccount):
+                bank.savings[account.account_number] = account
+        return bank
 
     def add_account(self, account):
+        self.index_account(account.account_number, account.owner, account.kind.__name__)
         self.accounts[account.account_number] = account
+        if isinstance(account, SavingsAccount) and self.store is None:
+            self.savings[account.account_number] = account
+        if self.ledger:
+            self.ledger.open_account(account)
         print(f"Account {account.account_number} added.")
 
+    def add_accounts(self, rows):
+        # adds accounts from rows of (account_number, owner, type, cents, transaction_fee,
+        # interest_rate), as read_accounts gives them, without printing; returns how many
+        for kind in {row[2] for row in rows} - ACCOUNT_TYPES.keys():
+            raise ValueError(f"Unknown account type {kind}")
+        if self.store is not None:
+            store = self.store
+            kinds = {name: ACCOUNT_KINDS.index(account_class) for name, account_class in ACCOUNT_TYPES.items()}
+            checking, savings = kinds["CheckingAccount"], kinds["SavingsAccount"]
+            store_rows = [(number, owner, kinds[kind], cents,
+                           to_cents(DEFAULT_TRANSACTION_FEE if fee is None else fee) if kinds[kind] == checking else 0,
+                           rate_units(DEFAULT_INTEREST_RATE if rate is None else rate) if kinds[kind] == savings else 0)
+                          for number, owner, kind, cents, fee, rate in rows]
+            numbers = [row[0] for row in rows]
+            if len(set(numbers)) < len(numbers) or not store.rows.keys().isdisjoint(numbers):
+                # some accounts replace others, which index_account has to see one by one
+                for row, store_row in zip(rows, store_rows):
+                    self.index_account(*row[:3])
+                    store.add_row(*store_row)
+                return len(rows)
+            for number, owner, kind, cents, fee, rate in rows:
+                self.by_owner[owner][number] = None
+                self.by_type[kind][number] = None
+            store.add_rows(store_rows)
+            return len(rows)
+        accounts = []
+        for number, owner, kind, cents, fee, rate in rows:
+            account_class = ACCOUNT_TYPES[kind]
+            # made without __init__, which would work out a zero balance first
+            account = account_class.__new__(account_class)
+            account.account_number = number
+            account.owner = owner
+            account.cents = cents
+            account.ledger = None
+            account.ledger_id = None
+            if account_class is CheckingAccount:
+                account.transaction_fee = DEFAULT_TRANSACTION_FEE if fee is None else fee
+            elif account_class is SavingsAccount:
+                account.interest_rate = DEFAULT_INTEREST_RATE if rate is None else rate
+                self.savings[number] = account
+            self.index_account(number, owner, kind)
+            self.accounts[number] = account
+            accounts.append(account)
+        if self.ledger:
+            self.ledger.open_accounts(accounts)
+        return len(accounts)
+
+    def import_accounts(self, filename, batch_size=100000):
+        # streams the accounts of a .csv or .jsonl file into the bank (see Bulk files); returns how many
+        file_format = bulk_format(filename)
+        added = 0
+        # the accounts make no reference cycles, and without this the collector's full passes
+        # would walk every account loaded so far again and again, taking longer than the parsing
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            with open(filename, newline='') as f:
+                for rows in read_accounts(f, file_format, batch_size):
+                    added += self.add_accounts(rows)
+        finally:
+            if collecting:
+                gc.enable()
+        return added
+
+    def export_accounts(self, filename, batch_size=100000):
+        # writes every account to a .csv or .jsonl file, batch_size accounts at a time; returns how many
+        file_format = bulk_format(filename)
+        rows = map(account_row, self.accounts.values())
+        written = 0
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w', newline='') as f:
+            if file_format == "csv":
+                writer = csv.writer(f)
+                writer.writerow(BULK_FIELDS)
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                if file_format == "csv":
+                    # None is written as an empty field
+                    writer.writerows(batch)
+                else:
+                    f.write("".join(json.dumps({name: value for name, value in zip(BULK_FIELDS, row) if value is not None})
+                                    + "\n" for row in batch))
+                written += len(batch)
+        os.replace(temp_filename, filename)
+        return written
+
+    # secondary indexes
+    # Every account is listed under its owner and its type when it is added, so find_accounts
+    # reads the matching account numbers instead of going through every account.
+
+    def index_account(self, account_number, owner, type_name):
+        if account_number in self.accounts:
+            # an account added again under the same number replaces the old one
+            previous = self.accounts[account_number]
+            del self.by_owner[previous.owner][account_number]
+            del self.by_type[previous.kind.__name__][account_number]
+            # and stops earning interest in apply_interest_all
+            if self.savings.get(account_number) is previous:
+                del self.savings[account_number]
+        self.by_owner[owner][account_number] = None
+        self.by_type[type_name][account_number] = None
+
+    def find_accounts(self, owner=None, account_type=None):
+        # the accounts of an owner, of a type (a class or its name), or both
+        if isinstance(account_type, type):
+            account_type = account_type.__name__
+        if owner is None and account_type is None:
+            return list(self.accounts.values())
+        # get, so a lookup doesn't add an empty entry to the defaultdict
+        if owner is None:
+            numbers = self.by_type.get(account_type, {})
+        else:
+            numbers = self.by_owner.get(owner, {})
+            if account_type is not None:
+                # the owner's accounts are usually few, so they are filtered rather than intersected
+                return [account for account in map(self.accounts.get, numbers)
+                        if account.kind.__name__ == account_type]
+        return [self.accounts[number] for number in numbers]
+
     def find_account(self, account_number):
         return self.accounts.get(account_number, None)
 
+    def apply_interest_all(self):
+        # posts interest to every savings account without printing: their balances and rates are
+        # read into columns, the interest of all of them is computed in one NumPy pass, and the
+        # new balances are written back. Meant for period ends, with no transfers running
+        if self.store is not None:
+            return self.store.apply_interest_all()
+        accounts = list(self.savings.values())
+        cents = [account.cents for account in accounts]
+        units = [rate_units(account.interest_rate) for account in accounts]
+        if numpy is not None and accounts and max(map(abs, cents)) * max(map(abs, units)) < 2 ** 63:
+            earned = interest_cents_array(numpy.array(cents, dtype=numpy.int64), numpy.array(units, dtype=numpy.int64))
+            balances = (numpy.array(cents, dtype=numpy.int64) + earned).tolist()
+        else:
+            # without NumPy, or for amounts too large for 64 bit products
+            earned = [interest_cents(amount, rate) for amount, rate in zip(cents, units)]
+            balances = [amount + interest for amount, interest in zip(cents, earned)]
+        for account, balance in zip(accounts, balances):
+            account.cents = balance
+        if self.ledger and accounts:
+            self.ledger.record_many([account.ledger_id for account in accounts], INTEREST, earned)
+        return {"accounts": len(accounts), "interest": int(sum(earned)) / 100}
+
     def transfer_funds(self, from_account_number, to_account_number, amount):
         from_account = self.find_account(from_account_number)
         to_account = self.find_account(to_account_number)
@@ -114,6 +449,534 @@ class Bank:
         else:
             print("One or both accounts not found.")
 
+
+# Account store
+# bank = Bank(store=AccountStore())
+# Keeps each account as one row across typed columns instead of one object: balances and
+# fees in cents and rates in billionths in array('q') columns, the kind of account in an
+# array('b'), and owners as codes into a list of their distinct names. store[number] (or
+# get, values, ...) returns a StoredAccount, a small view with the Account API that reads
+# and writes the row, so Bank and TransferEngine use a store as they use a dict of accounts.
+# apply_interest_all() works on the columns directly. A store does not keep a ledger.
+
+ACCOUNT_KINDS = (Account, CheckingAccount, SavingsAccount)
+
+
+class StoredAccount(Account):
+    __slots__ = ("store", "row")
+    # stored accounts are never journaled
+    ledger = None
+    ledger_id = None
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    @property
+    def account_number(self):
+        return self.store.numbers[self.row]
+
+    @property
+    def owner(self):
+        return self.store.owners[self.store.owner_codes[self.row]]
+
+    @property
+    def cents(self):
+        return self.store.cents[self.row]
+
+    @cents.setter
+    def cents(self, cents):
+        self.store.cents[self.row] = cents
+
+    @property
+    def kind(self):
+        return ACCOUNT_KINDS[self.store.kinds[self.row]]
+
+    @property
+    def transaction_fee(self):
+        if self.kind is not CheckingAccount:
+            raise AttributeError("Only checking accounts have a transaction fee")
+        return self.store.fees[self.row] / 100
+
+    @property
+    def interest_rate(self):
+        if self.kind is not SavingsAccount:
+            raise AttributeError("Only savings accounts have an interest rate")
+        return self.store.rates[self.row] / RATE_SCALE
+
+    # the behaviour of the row's kind of account, run on this view
+    def withdrawal_cost(self, amount):
+        return self.kind.withdrawal_cost(self, amount)
+
+    def withdraw(self, amount):
+        return self.kind.withdraw(self, amount)
+
+    def apply_interest(self):
+        if self.kind is not SavingsAccount:
+            raise AttributeError("Only savings accounts earn interest")
+        return SavingsAccount.apply_interest(self)
+
+
+class AccountStore:
+    def __init__(self):
+        # account number -> row
+        self.rows = {}
+        self.numbers = []
+        self.owner_codes = array.array('i')
+        self.owners = []
+        self.owner_index = {}
+        self.kinds = array.array('b')
+        self.cents = array.array('q')
+        self.fees = array.array('q')
+        self.rates = array.array('q')
+
+    def add(self, account):
+        # copies an account into a row
+        return self.add_row(account.account_number, account.owner, ACCOUNT_KINDS.index(account.kind),
+                            account.cents, to_cents(getattr(account, "transaction_fee", 0)),
+                            rate_units(getattr(account, "interest_rate", 0)))
+
+    def add_row(self, account_number, owner, kind, cents, fee_cents=0, rate=0):
+        # kind is a position in ACCOUNT_KINDS; an account number already stored has its row replaced
+        code = self.owner_index.get(owner)
+        if code is None:
+            code = self.owner_index[owner] = len(self.owners)
+            self.owners.append(owner)
+        row = self.rows.get(account_number)
+        if row is not None:
+            self.owner_codes[row], self.kinds[row] = code, kind
+            self.cents[row], self.fees[row], self.rates[row] = cents, fee_cents, rate
+            return row
+        row = self.rows[account_number] = len(self.numbers)
+        self.numbers.append(account_number)
+        self.owner_codes.append(code)
+        self.kinds.append(kind)
+        self.cents.append(cents)
+        self.fees.append(fee_cents)
+        self.rates.append(rate)
+        return row
+
+    def add_rows(self, rows):
+        # add_row for many rows of (account_number, owner, kind, cents, fee_cents, rate); when they
+        # are all new accounts the columns are extended in one go
+        if not rows:
+            return
+        numbers = [row[0] for row in rows]
+        if len(set(numbers)) < len(numbers) or not self.rows.keys().isdisjoint(numbers):
+            for row in rows:
+                self.add_row(*row)
+            return
+        _, owners, kinds, cents, fees, rates = zip(*rows)
+        # new owners get their codes in the order they first appear
+        for owner in dict.fromkeys(owners):
+            if owner not in self.owner_index:
+                self.owner_index[owner] = len(self.owners)
+                self.owners.append(owner)
+        self.rows.update(zip(numbers, range(len(self.numbers), len(self.numbers) + len(numbers))))
+        self.numbers.extend(numbers)
+        self.owner_codes.extend(map(self.owner_index.__getitem__, owners))
+        self.kinds.extend(kinds)
+        self.cents.extend(cents)
+        self.fees.extend(fees)
+        self.rates.extend(rates)
+
+    # the parts of the dict API that Bank and TransferEngine use
+
+    def __setitem__(self, account_number, account):
+        self.add(account)
+
+    def get(self, account_number, default=None):
+        row = self.rows.get(account_number)
+        return default if row is None else StoredAccount(self, row)
+
+    def __getitem__(self, account_number):
+        return StoredAccount(self, self.rows[account_number])
+
+    def __contains__(self, account_number):
+        return account_number in self.rows
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __iter__(self):
+        return iter(self.numbers)
+
+    def values(self):
+        return (StoredAccount(self, row) for row in range(len(self.numbers)))
+
+    def items(self):
+        return ((number, StoredAccount(self, row)) for row, number in enumerate(self.numbers))
+
+    def apply_interest_all(self):
+        # interest_cents for every savings row at once, added to the balance column in place
+        savings = ACCOUNT_KINDS.index(SavingsAccount)
+        if numpy is not None and self.numbers:
+            kinds = numpy.frombuffer(self.kinds, dtype=numpy.int8)
+            rows = numpy.flatnonzero(kinds == savings)
+            cents = numpy.frombuffer(self.cents, dtype=numpy.int64)
+            units = numpy.frombuffer(self.rates, dtype=numpy.int64)[rows]
+            if not len(rows) or int(numpy.abs(cents[rows]).max()) * int(numpy.abs(units).max()) < 2 ** 63:
+                earned = interest_cents_array(cents[rows], units)
+                cents[rows] += earned
+                total = int(earned.sum())
+                # the views have to go before the columns can grow again
+                del kinds, cents
+                return {"accounts": len(rows), "interest": total / 100}
+            del kinds, cents
+        # without NumPy, or for amounts too large for 64 bit products
+        rows = [row for row, kind in enumerate(self.kinds) if kind == savings]
+        total = 0
+        for row in rows:
+            earned = interest_cents(self.cents[row], self.rates[row])
+            self.cents[row] += earned
+            total += earned
+        return {"accounts": len(rows), "interest": total / 100}
+
+
+# Transfer engine
+# engine = TransferEngine(bank)
+# results = engine.run([("001", "002", 100), ("002", "003", 25.5)])
+# Each result is a dict {"from", "to", "amount", "ok", "error"}, in the order of the batch;
+# nothing is printed. A transfer takes the sending account's withdrawal cost (amount plus
+# the fee for checking accounts) and credits amount, or changes nothing when it fails.
+# A batch gives the same results as running its transfers one by one in order: transfers
+# are put in waves where no two share an account, each wave after the ones holding earlier
+# transfers of its accounts, and with workers > 1 a wave is split across that many threads. Both
+# accounts of a transfer are locked (their stripes of LOCK_STRIPES, in stripe order), so concurrent
+# batches can't deadlock.
+# A transfer is pure Python and holds the GIL, so worker threads never add throughput: the waves
+# and hand-offs only cost time (python bench_task_bank.py --transfers 200000 measures it), which
+# is why workers defaults to 1. The threads are for thread safety, not for speed.
+
+class TransferEngine:
+    def __init__(self, bank, workers=1, chunk_size=1024):
+        self.bank = bank
+        self.workers = workers
+        # waves smaller than this are run in the calling thread
+        self.chunk_size = chunk_size
+        self.executor = None
+        self.settled = 0
+        self.failed = 0
+        self.counts_lock = threading.Lock()
+
+    def transfer(self, from_account_number, to_account_number, amount):
+        result = {"from": from_account_number, "to": to_account_number, "amount": amount, "ok": False, "error": None}
+        source = self.bank.accounts.get(from_account_number)
+        target = self.bank.accounts.get(to_account_number)
+        if source is None or target is None:
+            result["error"] = "account not found"
+        elif from_account_number == to_account_number:
+            result["error"] = "same account"
+        elif not amount > 0:
+            result["error"] = "amount must be positive"
+        else:
+            numbers = sorted({source.lock_number, target.lock_number})
+            for number in numbers:
+                LOCK_STRIPES[number].acquire()
+            try:
+                cost = to_cents(source.withdrawal_cost(amount))
+                if cost <= source.cents:
+                    source.cents -= cost
+                    target.cents += to_cents(amount)
+                    result["ok"] = True
+                    if source.ledger:
+                        source.ledger.record(source, WITHDRAW, -amount)
+                        if cost != to_cents(amount):
+                            source.ledger.record(source, FEE, (to_cents(amount) - cost) / 100)
+                    if target.ledger:
+                        target.ledger.record(target, DEPOSIT, amount)
+                else:
+                    result["error"] = "insufficient funds"
+            finally:
+                for number in reversed(numbers):
+                    LOCK_STRIPES[number].release()
+        return result
+
+    def run_chunk(self, transfers):
+        return [self.transfer(*transfer) for transfer in transfers]
+
+    def waves(self, transfers):
+        # the number of each transfer's wave: one more than the last wave using either of its accounts
+        last = {}
+        waves = []
+        for from_account_number, to_account_number, amount in transfers:
+            wave = max(last.get(from_account_number, -1), last.get(to_account_number, -1)) + 1
+            last[from_account_number] = last[to_account_number] = wave
+            waves.append(wave)
+        return waves
+
+    def run(self, transfers):
+        transfers = list(transfers)
+        if self.workers == 1 or len(transfers) <= self.chunk_size:
+            results = self.run_chunk(transfers)
+        else:
+            results = [None] * len(transfers)
+            grouped = {}
+            for number, wave in enumerate(self.waves(transfers)):
+                grouped.setdefault(wave, []).append(number)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers)
+            for wave in range(len(grouped)):
+                numbers = grouped[wave]
+                size = max(self.chunk_size, -(-len(numbers) // self.workers))
+                chunks = [numbers[start:start + size] for start in range(0, len(numbers), size)]
+                if len(chunks) == 1:
+                    done = [self.run_chunk([transfers[number] for number in numbers])]
+                else:
+                    done = list(self.executor.map(self.run_chunk, [[transfers[number] for number in chunk]
+                                                                   for chunk in chunks]))
+                for chunk, chunk_results in zip(chunks, done):
+                    for number, result in zip(chunk, chunk_results):
+                        results[number] = result
+        settled = sum(result["ok"] for result in results)
+        with self.counts_lock:
+            self.settled += settled
+            self.failed += len(results) - settled
+        return results
+
+    def stats(self):
+        return {"settled": self.settled, "failed": self.failed}
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+# Ledger
+# bank = Bank(ledger=Ledger("bank.ledger"))      every change of a balance is journaled
+# bank = Bank.recover("bank.ledger")             rebuilds the accounts and their balances
+# The journal (bank.ledger) is append-only: one 13 byte record per event, holding the kind
+# (open, deposit, withdraw, fee, interest), the account's id and the signed change in cents.
+# bank.ledger.accounts names the account of each id, one JSON line per account; an account number
+# reused for a different account adds a line starting with the id it keeps, which replaces the first.
+# The ledger keeps every balance in cents; every snapshot_every records (and on checkpoint)
+# those balances are written to bank.ledger.snapshot with the journal length they include,
+# so recovery reads the snapshot and replays at most snapshot_every records after it,
+# however long the journal grows. Records reach the disk on flush(), checkpoint() and close(),
+# or after every record with sync=True. A torn record at the end of the journal is dropped.
+
+OPEN, DEPOSIT, WITHDRAW, FEE, INTEREST = range(5)
+RECORD = struct.Struct("<BIq")
+# the same layout, for reading whole blocks of records with NumPy
+RECORD_DTYPE = numpy.dtype([("kind", "u1"), ("account", "<u4"), ("cents", "<i8")]) if numpy is not None else None
+SNAPSHOT_HEADER = struct.Struct("<8sQQ")
+SNAPSHOT_MAGIC = b"LEDGSNP1"
+
+
+class Ledger:
+    def __init__(self, filename, snapshot_every=1000000, sync=False):
+        self.filename = filename
+        self.snapshot_every = snapshot_every
+        self.sync = sync
+        self.lock = threading.Lock()
+        # account number -> id, and the description of each id
+        self.ids = {}
+        self.descriptions = []
+        self.balances = array.array('q')
+        self.entries = 0
+        self.snapshot_entries = 0
+        self.recover()
+        self.journal = open(filename, 'ab')
+        self.journal.truncate(self.entries * RECORD.size)
+        self.accounts_file = open(filename + '.accounts', 'a')
+
+    def open_account(self, account):
+        # gives the account an id and journals its opening balance. An account seen before keeps its
+        # id, and an OPEN record of the difference brings the ledger to the balance it opens with
+        with self.lock:
+            account_id = self.ids.get(account.account_number)
+            if account_id is None:
+                account_id = self.describe(account)
+                # the account is named before any record refers to it
+                self.accounts_file.flush()
+            elif self.description(account) != self.descriptions[account_id]:
+                # the number now belongs to a different account (another owner or type)
+                self.describe(account, account_id)
+                self.accounts_file.flush()
+            if account.cents != self.balances[account_id]:
+                self.append(OPEN, account_id, account.cents - self.balances[account_id])
+        account.ledger = self
+        account.ledger_id = account_id
+
+    def open_accounts(self, accounts):
+        # open_account for many accounts, with their descriptions written in one go and
+        # their opening balances journaled by one record_many
+        # the balance each id opens with, so an account number given twice is journaled once
+        opened = {}
+        with self.lock:
+            for account in accounts:
+                account_id = self.ids.get(account.account_number)
+                if account_id is None:
+                    account_id = self.describe(account)
+                elif self.description(account) != self.descriptions[account_id]:
+                    self.describe(account, account_id)
+                opened[account_id] = account.cents
+                account.ledger = self
+                account.ledger_id = account_id
+            self.accounts_file.flush()
+            changes = [(account_id, cents - self.balances[account_id]) for account_id, cents in opened.items()
+                       if cents != self.balances[account_id]]
+        if changes:
+            self.record_many([account_id for account_id, _ in changes], OPEN, [cents for _, cents in changes])
+
+    def description(self, account):
+        description = {"account_number": account.account_number, "owner": account.owner,
+                       "type": account.kind.__name__}
+        for name in ("transaction_fee", "interest_rate"):
+            if hasattr(account, name):
+                description[name] = getattr(account, name)
+        return description
+
+    def describe(self, account, account_id=None):
+        # a new id for the account, named in the .accounts file. An account number that is reused
+        # keeps its id and is described again by a line starting with that id; the last one wins
+        description = self.description(account)
+        if account_id is None:
+            account_id = self.ids[account.account_number] = len(self.descriptions)
+            self.descriptions.append(description)
+            self.balances.append(0)
+            self.accounts_file.write(json.dumps(description) + "\n")
+        else:
+            self.descriptions[account_id] = description
+            self.accounts_file.write(json.dumps({"id": account_id, **description}) + "\n")
+        return account_id
+
+    def record(self, account, kind, amount):
+        # amount is signed: deposits and interest add to the balance, withdrawals and fees take from it
+        with self.lock:
+            self.append(kind, account.ledger_id, to_cents(amount))
+
+    def append(self, kind, account_id, cents):
+        self.journal.write(RECORD.pack(kind, account_id, cents))
+        self.balances[account_id] += cents
+        self.appended(1)
+
+    def record_many(self, account_ids, kind, cents):
+        # one record per account, written in one go; cents are already whole cents
+        with self.lock:
+            if numpy is not None:
+                records = numpy.empty(len(account_ids), dtype=RECORD_DTYPE)
+                records["kind"] = kind
+                records["account"] = account_ids
+                records["cents"] = cents
+                self.journal.write(records.tobytes())
+                balances = numpy.frombuffer(self.balances, dtype=numpy.int64)
+                numpy.add.at(balances, numpy.asarray(account_ids, dtype=numpy.intp), numpy.asarray(cents, dtype=numpy.int64))
+                # the view has to go before the balances can grow again
+                del balances
+            else:
+                for account_id, amount in zip(account_ids, cents):
+                    self.journal.write(RECORD.pack(kind, account_id, amount))
+                    self.balances[account_id] += amount
+            self.appended(len(account_ids))
+
+    def appended(self, count):
+        self.entries += count
+        if self.sync:
+            self.sync_files()
+        if self.entries - self.snapshot_entries >= self.snapshot_every:
+            self.write_snapshot()
+
+    def balance(self, account_number):
+        # in cents
+        return self.balances[self.ids[account_number]]
+
+    def flush(self):
+        with self.lock:
+            self.sync_files()
+
+    def sync_files(self):
+        # the account names first, so the journal never refers to an account that could be lost
+        os.fsync(self.accounts_file.fileno())
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def checkpoint(self):
+        with self.lock:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        # the journal is made durable first, so a snapshot never covers records that could be lost
+        self.sync_files()
+        temp_filename = self.filename + '.snapshot.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.entries, len(self.balances)))
+            f.write(self.balances.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, self.filename + '.snapshot')
+        self.snapshot_entries = self.entries
+
+    def recover(self):
+        # balances from the snapshot, then the journal records written after it
+        try:
+            with open(self.filename + '.accounts') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        text = "[" + ",".join(lines) + "]"
+        try:
+            # parsed as one JSON list, much faster than line by line
+            self.descriptions = json.loads(text)
+        except ValueError:
+            # the last line was torn by a crash; no record refers to it, since the journal is synced after it
+            self.descriptions = [json.loads(line) for line in lines[:-1]]
+        if '{"id": ' in text:
+            # account numbers described again under the id they already had (see describe)
+            descriptions = self.descriptions
+            self.descriptions = []
+            for description in descriptions:
+                account_id = description.pop("id", None)
+                if account_id is None:
+                    self.descriptions.append(description)
+                else:
+                    self.descriptions[account_id] = description
+        self.ids = {description["account_number"]: number for number, description in enumerate(self.descriptions)}
+        self.balances = array.array('q', bytes(8 * len(self.descriptions)))
+        try:
+            with open(self.filename + '.snapshot', 'rb') as f:
+                magic, entries, accounts = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+                if magic != SNAPSHOT_MAGIC:
+                    raise ValueError(f"{self.filename}.snapshot is not a ledger snapshot")
+                self.balances[:accounts] = array.array('q', f.read(8 * accounts))
+                self.entries = self.snapshot_entries = entries
+        except FileNotFoundError:
+            pass
+        try:
+            with open(self.filename, 'rb') as f:
+                f.seek(self.entries * RECORD.size)
+                self.entries += self.replay(f)
+        except FileNotFoundError:
+            pass
+
+    def replay(self, f, block=1 << 22):
+        # adds the records read from f to the balances, a block of records at a time, and returns how many
+        # there were; with NumPy a block is summed per account in one pass
+        replayed = 0
+        while True:
+            data = f.read(block * RECORD.size)
+            data = data[:len(data) - len(data) % RECORD.size]
+            if not data:
+                return replayed
+            if numpy is not None:
+                records = numpy.frombuffer(data, dtype=RECORD_DTYPE)
+                balances = numpy.frombuffer(self.balances, dtype=numpy.int64)
+                # the packed fields are copied out first: add.at is many times slower on unaligned strides
+                numpy.add.at(balances, records["account"].astype(numpy.intp), numpy.ascontiguousarray(records["cents"]))
+            else:
+                balances = self.balances
+                for kind, account_id, cents in RECORD.iter_unpack(data):
+                    balances[account_id] += cents
+            replayed += len(data) // RECORD.size
+            if len(data) < block * RECORD.size:
+                return replayed
+
+    def close(self):
+        with self.lock:
+            self.sync_files()
+            self.journal.close()
+            self.accounts_file.close()
+
 # Example usage
 bank = Bank()
 
@@ -129,6 +992,15 @@ acc2.apply_interest()
 
 bank.transfer_funds("001", "002", 100)
 
+engine = TransferEngine(bank)
+for result in engine.run([("001", "002", 50), ("002", "001", 20), ("001", "999", 5)]):
+    print(result)
+engine.close()
+
+# the indexes answer by owner or type without going through every account
+print([account.account_number for account in bank.find_accounts(owner="Alice")])
+print([account.account_number for account in bank.find_accounts(account_type=SavingsAccount)])
+
 # ------------------------------------
 # ----------- Functions --------------
 # ------------------------------------